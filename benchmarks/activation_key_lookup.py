@@ -0,0 +1,86 @@
+"""Measures activation key lookups against a growing profile table.
+
+For each table size, keys are looked up with
+``RegistrationProfile.objects.get_by_activation_key``, as
+``RegistrationManager.activate_user`` and ``Backend.get_profile`` do:
+
+* existing keys, looked up for the first time and again once their primary
+  key is cached;
+* unknown keys, looked up for the first time and again once they are known
+  to be missing.
+
+The latency and number of queries per lookup are reported for each. Pass
+``--no-key-cache`` to measure without the key cache.
+"""
+import random
+
+import utils
+
+
+def lookup(key):
+    from registration.models import RegistrationProfile
+    RegistrationProfile.objects.get_by_activation_key(key)
+
+
+def measure(keys):
+    "Looks up each of ``keys``, returning the timings and queries per lookup."
+    timings = []
+
+    with utils.QueryCounter() as counter:
+        for key in keys:
+            timings.append(utils.timed(lookup, key))
+
+    return utils.summarize(timings), counter.count / float(len(keys))
+
+
+def main():
+    parser = utils.get_parser(__doc__)
+    parser.add_argument('--sizes', default='1000,10000,100000',
+        help='Comma-separated table sizes to measure')
+    parser.add_argument('--lookups', type=int, default=500,
+        help='Number of lookups of each kind per table size')
+    parser.add_argument('--no-key-cache', action='store_true',
+        help='Disable the activation key cache')
+    options = parser.parse_args()
+
+    # large enough that no key is culled from the cache during a run
+    extra = {'CACHES': {'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'OPTIONS': {'MAX_ENTRIES': 1000000},
+    }}}
+    if options.no_key_cache:
+        extra['REGISTRATION_KEY_CACHE'] = None
+
+    name = utils.setup(options, **extra)
+    results = []
+    keys = []
+
+    try:
+        for size in [int(x) for x in options.sizes.split(',')]:
+            keys.extend(utils.seed_profiles(size - len(keys)))
+
+            found = random.sample(keys, min(options.lookups, len(keys)))
+            missing = [utils.random_key() for i in xrange(options.lookups)]
+
+            result = {'size': size}
+
+            # the second pass over the same keys is served by the cache
+            for kind, sample in (('found', found), ('missing', missing)):
+                result[kind], result[kind + '_queries'] = measure(sample)
+                result[kind + '_cached'], result[kind + '_cached_queries'] = measure(sample)
+
+            results.append(result)
+
+            print '{0:>10} rows:'.format(size)
+            for kind in ('found', 'found_cached', 'missing', 'missing_cached'):
+                print '    {0:>15}: p50 {1:.3f}ms p95 {2:.3f}ms, {3:.1f} queries/lookup'.format(
+                    kind, result[kind]['p50'], result[kind]['p95'],
+                    result[kind + '_queries'])
+    finally:
+        utils.teardown(name)
+
+    utils.report(options, results)
+
+
+if __name__ == '__main__':
+    main()
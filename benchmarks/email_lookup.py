@@ -0,0 +1,57 @@
+"""Measures the email uniqueness check run by ``RegistrationForm``.
+
+The user table is seeded with ``--size`` users, then the case-insensitive
+``iexact`` lookup and the exact lookup used with
+``REGISTRATION_NORMALIZE_EMAIL`` are timed for taken and free addresses.
+Run with ``--migrate`` to include the email indexes created by the
+migrations.
+"""
+import random
+
+import utils
+
+
+def exists(**lookup):
+    from registration.user import User
+    return User.objects.filter(**lookup).exists()
+
+
+def main():
+    parser = utils.get_parser(__doc__)
+    parser.add_argument('--size', type=int, default=100000,
+        help='Number of users to seed')
+    parser.add_argument('--lookups', type=int, default=200)
+    options = parser.parse_args()
+
+    name = utils.setup(options)
+    results = []
+
+    try:
+        utils.seed_profiles(options.size, batch_size=5000)
+
+        for label, lookup in (('iexact', 'email__iexact'), ('normalized', 'email')):
+            taken, free = [], []
+
+            for i in xrange(options.lookups):
+                email = 'bench{0}@example.com'.format(random.randrange(options.size))
+                taken.append(utils.timed(exists, **{lookup: email}))
+                free.append(utils.timed(exists, **{lookup: 'free' + email}))
+
+            result = {
+                'lookup': label,
+                'size': options.size,
+                'taken': utils.summarize(taken),
+                'free': utils.summarize(free),
+            }
+            results.append(result)
+
+            print '{0}: taken p50 {1:.3f}ms, free p50 {2:.3f}ms'.format(label,
+                result['taken']['p50'], result['free']['p50'])
+    finally:
+        utils.teardown(name)
+
+    utils.report(options, results)
+
+
+if __name__ == '__main__':
+    main()
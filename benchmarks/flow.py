@@ -0,0 +1,197 @@
+"""Drives the registration views through the full moderated flow.
+
+Each simulated user registers, follows the verification link and is
+approved by a moderator, who also pages through the moderation queue. The
+requests are made with the Django test client from ``--concurrency``
+threads, against a profile table seeded with ``--seed`` registrations.
+Throughput, latency percentiles and queries per request are reported for
+each view, e.g.::
+
+    python benchmarks/flow.py --users 500 --concurrency 4 --output flow.json
+
+Emails are sent with the locmem backend as soon as each step commits.
+"""
+import os
+import re
+import time
+import threading
+
+import utils
+
+PASSWORD = 'Benchmark1!'
+
+VIEWS = ('register', 'verify', 'moderate_list', 'moderate')
+
+NEXT_CURSOR_RE = re.compile(r'\?after=(\d+)')
+
+
+class Worker(threading.Thread):
+    "Runs the flow for a range of users, recording each request."
+    def __init__(self, users, list_pages):
+        super(Worker, self).__init__()
+        self.users = users
+        self.list_pages = list_pages
+        self.timings = dict((view, []) for view in VIEWS)
+        self.queries = dict((view, 0) for view in VIEWS)
+        self.errors = []
+
+    def request(self, view, method, path, data=None, status=(200, 302)):
+        from django.db import connection
+
+        connection.queries = []
+        start = time.time()
+        response = getattr(self.client, method)(path, data or {})
+        self.timings[view].append((time.time() - start) * 1000)
+        self.queries[view] += len(connection.queries)
+
+        if response.status_code not in status:
+            self.errors.append('{0} {1}: {2}'.format(method.upper(), path,
+                response.status_code))
+
+        return response
+
+    def run(self):
+        from django.db import connection
+        from django.test.client import Client
+
+        connection.use_debug_cursor = True
+
+        self.client = Client()
+        self.client.login(username='moderator', password=PASSWORD)
+
+        try:
+            for username in self.users:
+                try:
+                    self.flow(username)
+                except Exception, e:
+                    self.errors.append('{0}: {1!r}'.format(username, e))
+        finally:
+            connection.close()
+
+    def flow(self, username):
+        from registration.models import RegistrationProfile
+
+        self.request('register', 'post', '/register/', {
+            'username': username,
+            'first_name': 'Bench',
+            'last_name': 'Mark',
+            'email': username + '@example.com',
+            'password1': PASSWORD,
+            'password2': PASSWORD,
+        })
+
+        # the key is normally read from the email
+        key = RegistrationProfile.objects.filter(user__username=username)\
+            .values_list('activation_key', flat=True)[0]
+
+        self.request('verify', 'get', '/verify/{0}/'.format(key))
+
+        data = {}
+        for i in xrange(self.list_pages):
+            response = self.request('moderate_list', 'get', '/moderate/', data)
+
+            # the test client's record of template contexts is not
+            # thread-safe, so the next page is read from the link
+            match = NEXT_CURSOR_RE.search(response.content)
+            if not match:
+                break
+            data = {'after': match.group(1)}
+
+        self.request('moderate', 'post', '/moderate/{0}/'.format(key),
+            {'status': 'approve'})
+
+
+def main():
+    parser = utils.get_parser(__doc__)
+    parser.add_argument('--users', type=int, default=200,
+        help='Number of users taken through the flow')
+    parser.add_argument('--concurrency', type=int, default=1,
+        help='Number of threads making requests')
+    parser.add_argument('--seed', type=int, default=10000,
+        help='Number of verified, unmoderated registrations seeded beforehand')
+    parser.add_argument('--list-pages', type=int, default=1,
+        help='Pages of the moderation queue fetched per user')
+    options = parser.parse_args()
+
+    # requests are made from other threads than the one creating the database
+    name = utils.setup(options, shared=True,
+        ROOT_URLCONF='registration.urls',
+        TEMPLATE_DIRS=(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates'),),
+        MIDDLEWARE_CLASSES=(
+            'django.contrib.sessions.middleware.SessionMiddleware',
+            'django.contrib.auth.middleware.AuthenticationMiddleware',
+        ),
+        apps=('django.contrib.sessions',),
+        REGISTRATION_MODERATION=True,
+        REGISTRATION_EMAIL_QUEUE='registration.mail.ImmediateQueue',
+        REGISTRATION_METRICS_SINK=None)
+
+    try:
+        from django.core import mail
+        from registration.user import User
+
+        mail.outbox = []
+
+        moderator = User(username='moderator', is_staff=True, is_superuser=True)
+        moderator.set_password(PASSWORD)
+        moderator.save()
+
+        utils.seed_profiles(options.seed, batch_size=5000, verified=True)
+
+        usernames = ['flow{0}'.format(i) for i in xrange(options.users)]
+        workers = [Worker(usernames[i::options.concurrency], options.list_pages)
+            for i in xrange(options.concurrency)]
+
+        start = time.time()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.time() - start
+
+        results = []
+        for view in VIEWS:
+            timings = sum((worker.timings[view] for worker in workers), [])
+            queries = sum(worker.queries[view] for worker in workers)
+
+            result = {
+                'view': view,
+                'requests': len(timings),
+                'latency': utils.summarize(timings),
+                'queries_per_request': queries / float(len(timings)) if timings else None,
+            }
+            results.append(result)
+
+            if not timings:
+                continue
+
+            print '{0:>14}: {1} requests, p50 {2:.3f}ms p95 {3:.3f}ms p99 {4:.3f}ms, ' \
+                '{5:.1f} queries/request'.format(view, result['requests'],
+                    result['latency']['p50'], result['latency']['p95'],
+                    result['latency']['p99'], result['queries_per_request'])
+
+        errors = sum((worker.errors for worker in workers), [])
+
+        summary = {
+            'users': options.users,
+            'concurrency': options.concurrency,
+            'seed': options.seed,
+            'elapsed': elapsed,
+            'users_per_second': options.users / elapsed,
+            'requests_per_second': sum(result['requests'] for result in results) / elapsed,
+            'emails': len(mail.outbox),
+            'errors': errors,
+        }
+
+        print '{0} users in {1:.2f}s ({2:.1f} users/s), {3} emails, {4} errors'.format(
+            options.users, elapsed, options.users / elapsed, len(mail.outbox), len(errors))
+        for error in errors[:10]:
+            print '    ' + error
+    finally:
+        utils.teardown(name)
+
+    utils.report(options, results, **summary)
+
+
+if __name__ == '__main__':
+    main()
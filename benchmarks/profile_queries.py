@@ -0,0 +1,88 @@
+"""Reports query plans and latencies of the backend's profile accessors.
+
+The profile table is seeded with a mix of registrations in each stage of
+the process, then ``get_unverified_profiles``, ``get_unmoderated_profiles``
+and ``get_inactivated_profiles`` are measured fetching the first page and
+counting all matching rows. Run with ``--migrate`` to include the indexes
+created by the migrations, and with ``--state`` to look the profiles up by
+their state rather than their flags.
+"""
+import utils
+
+# fraction of the seeded profiles in each stage
+STAGES = (
+    (0.6, {}),
+    (0.1, {'verified': True}),
+    (0.05, {'verified': True, 'moderated': True}),
+    (0.25, {'verified': True, 'moderated': True, 'activated': True}),
+)
+
+ACCESSORS = ('get_unverified_profiles', 'get_unmoderated_profiles',
+    'get_inactivated_profiles')
+
+EXPLAIN = {
+    'postgresql': 'EXPLAIN ANALYZE ',
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+}
+
+
+def explain(queryset):
+    from django.db import connection
+
+    prefix = EXPLAIN.get(connection.vendor, 'EXPLAIN ')
+    sql, params = queryset.query.sql_with_params()
+
+    cursor = connection.cursor()
+    cursor.execute(prefix + sql, params)
+    return [' '.join(unicode(x) for x in row) for row in cursor.fetchall()]
+
+
+def main():
+    parser = utils.get_parser(__doc__)
+    parser.add_argument('--size', type=int, default=100000,
+        help='Number of profiles to seed')
+    parser.add_argument('--page-size', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=20,
+        help='Number of times each query is timed')
+    parser.add_argument('--state', action='store_true',
+        help='Look profiles up by state (REGISTRATION_PROFILE_STATE)')
+    options = parser.parse_args()
+
+    name = utils.setup(options, REGISTRATION_PROFILE_STATE=options.state)
+    results = []
+
+    try:
+        from registration.backends import get_backend
+
+        for fraction, fields in STAGES:
+            utils.seed_profiles(int(options.size * fraction), batch_size=5000, **fields)
+
+        backend = get_backend('default')
+
+        for accessor in ACCESSORS:
+            queryset = getattr(backend, accessor)(None).order_by('pk')
+            page = queryset[:options.page_size]
+
+            result = {
+                'accessor': accessor,
+                'size': options.size,
+                'plan': explain(page),
+                'page': utils.summarize([utils.timed(list, page.all())
+                    for i in xrange(options.repeat)]),
+                'count': utils.summarize([utils.timed(queryset.count)
+                    for i in xrange(options.repeat)]),
+            }
+            results.append(result)
+
+            print '{0}: page p50 {1:.3f}ms, count p50 {2:.3f}ms'.format(accessor,
+                result['page']['p50'], result['count']['p50'])
+            for line in result['plan']:
+                print '    ' + line
+    finally:
+        utils.teardown(name)
+
+    utils.report(options, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""Measures signup throughput with random usernames under concurrency.
+
+Each of ``--concurrency`` threads inserts ``--signups`` users. The current
+generator, which needs no query and relies on the insert to catch
+collisions, is compared with checking the database for every candidate
+before inserting. For meaningful numbers under concurrency use a database
+with row-level locking, e.g. ``--engine postgresql_psycopg2``.
+"""
+import time
+import random
+import threading
+
+import utils
+
+
+def checked_username(attempts=10):
+    "The previous approach: draw a number until it is not taken."
+    from registration.user import User
+
+    for i in xrange(attempts):
+        username = str(random.SystemRandom().randint(10 ** 10, 30 ** 10))
+        if not User.objects.filter(username=username).exists():
+            return username
+
+    raise StandardError('max attempts have been reached (n={0})'.format(attempts))
+
+
+def signup_checked():
+    from registration.user import User
+
+    user = User(email='bench@example.com', password='!')
+    user.username = checked_username()
+    user.save()
+
+
+def signup_generated():
+    from registration.user import User
+    from registration.utils import save_with_random_username
+
+    save_with_random_username(User(email='bench@example.com', password='!'))
+
+
+def run(func, concurrency, signups):
+    """Calls ``func`` ``signups`` times on each of ``concurrency`` threads.
+    Returns the throughput, the timings and the number of errors.
+    """
+    from django.db import connection
+
+    timings = []
+    errors = []
+
+    def work():
+        try:
+            for i in xrange(signups):
+                try:
+                    timings.append(utils.timed(func))
+                except Exception, e:
+                    errors.append(e)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=work) for i in xrange(concurrency)]
+
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    return len(timings) / elapsed, timings, len(errors)
+
+
+def main():
+    parser = utils.get_parser(__doc__)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--signups', type=int, default=200,
+        help='Number of signups per thread')
+    options = parser.parse_args()
+
+    name = utils.setup(options, shared=True)
+    results = []
+
+    try:
+        for label, func in (('checked', signup_checked), ('generated', signup_generated)):
+            throughput, timings, errors = run(func, options.concurrency, options.signups)
+
+            results.append({
+                'generator': label,
+                'concurrency': options.concurrency,
+                'throughput': throughput,
+                'latency': utils.summarize(timings),
+                'errors': errors,
+            })
+
+            print '{0}: {1:.1f} signups/s, p95 {2:.3f}ms, {3} errors'.format(label,
+                throughput, utils.percentile(timings, 95), errors)
+    finally:
+        utils.teardown(name)
+
+    utils.report(options, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+"""Shared setup for the benchmark scripts in this directory.
+
+The scripts configure a throwaway Django project on the fly so they can be
+run straight from a checkout, e.g.::
+
+    python benchmarks/activation_key_lookup.py --sizes 1000,10000,100000
+
+SQLite is used by default. Pass ``--engine`` and ``--name`` (and the usual
+connection options) to run against another database, e.g. a local
+PostgreSQL. A separate test database is created and destroyed by each run,
+so the named database is never written to. Pass ``--migrate`` to create it
+with the South migrations, which include indexes ``syncdb`` does not create.
+"""
+import os
+import sys
+import time
+import json
+import random
+import hashlib
+import argparse
+from datetime import datetime
+
+# make the package importable when running from a checkout
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+def get_parser(description):
+    "Returns an argument parser with the common database options."
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--engine', default='sqlite3',
+        help='Database backend, e.g. sqlite3 or postgresql_psycopg2')
+    parser.add_argument('--name', default='registration_benchmark',
+        help='Database name. The test database is derived from this')
+    parser.add_argument('--user', default='')
+    parser.add_argument('--password', default='')
+    parser.add_argument('--host', default='')
+    parser.add_argument('--port', default='')
+    parser.add_argument('--migrate', action='store_true',
+        help='Create the tables with the South migrations')
+    parser.add_argument('--output', help='Write results as JSON to this path')
+    return parser
+
+
+def setup(options, shared=False, apps=(), **extra):
+    """Configures Django for the given options and creates the test
+    database. Returns the name of the created database.
+
+    If ``shared`` is true, SQLite uses a database file rather than memory so
+    connections from several threads see the same database. ``apps`` are
+    added to ``INSTALLED_APPS`` and ``extra`` settings override the defaults.
+    """
+    from django.conf import settings
+
+    engine = options.engine
+    if '.' not in engine:
+        engine = 'django.db.backends.' + engine
+
+    config = {
+        'DEBUG': False,
+        'DATABASES': {
+            'default': {
+                'ENGINE': engine,
+                'NAME': options.name,
+                'USER': options.user,
+                'PASSWORD': options.password,
+                'HOST': options.host,
+                'PORT': options.port,
+            },
+        },
+        'INSTALLED_APPS': (
+            'django.contrib.auth',
+            'django.contrib.contenttypes',
+            'django.contrib.sites',
+            'registration',
+        ) + tuple(apps),
+        'SITE_ID': 1,
+        'SECRET_KEY': 'benchmark',
+        'EMAIL_BACKEND': 'django.core.mail.backends.locmem.EmailBackend',
+        'DEFAULT_FROM_EMAIL': 'benchmark@example.com',
+        'MANAGERS': (('Moderator', 'moderator@example.com'),),
+    }
+    if shared and engine.endswith('sqlite3'):
+        config['DATABASES']['default'].update({
+            'TEST_NAME': options.name + '.sqlite3',
+            'OPTIONS': {'timeout': 30},
+        })
+
+    if options.migrate:
+        config['INSTALLED_APPS'] += ('south',)
+        config['SOUTH_TESTS_MIGRATE'] = True
+
+    config.update(extra)
+    settings.configure(**config)
+
+    if options.migrate:
+        from south.management.commands import patch_for_test_db_setup
+        patch_for_test_db_setup()
+
+    from django.db import connection
+    return connection.creation.create_test_db(verbosity=0, autoclobber=True)
+
+
+def teardown(name):
+    from django.db import connection
+    connection.creation.destroy_test_db(name, verbosity=0)
+
+
+def random_key():
+    "Returns a random key shaped like a generated activation key."
+    return hashlib.sha1(str(random.random())).hexdigest()
+
+
+def seed_profiles(count, batch_size=1000, **fields):
+    """Inserts ``count`` users, each with a registration profile, in batches.
+    Additional ``fields`` are set on every profile. Returns the list of
+    activation keys that were created.
+    """
+    from registration.user import User
+    from registration.models import RegistrationProfile
+
+    keys = []
+    start = User.objects.count()
+    now = datetime.now()
+
+    for offset in xrange(0, count, batch_size):
+        size = min(batch_size, count - offset)
+        names = ['bench{0}'.format(start + offset + i) for i in xrange(size)]
+
+        User.objects.bulk_create([User(username=name, email=name + '@example.com',
+            password='!', is_active=False, date_joined=now, last_login=now)
+            for name in names])
+
+        pks = User.objects.filter(username__in=names).values_list('pk', flat=True)
+
+        profiles = []
+        for pk in pks:
+            key = random_key()
+            keys.append(key)
+            profiles.append(RegistrationProfile(user_id=pk, activation_key=key, **fields))
+
+        RegistrationProfile.objects.bulk_create(profiles)
+
+    return keys
+
+
+class QueryCounter(object):
+    "Context manager which counts the queries executed within the block."
+    def __enter__(self):
+        from django.db import connection
+        self.connection = connection
+        self.debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        self.start = len(connection.queries)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.count = len(self.connection.queries) - self.start
+        self.connection.use_debug_cursor = self.debug_cursor
+
+
+def timed(func, *args, **kwargs):
+    "Calls ``func`` and returns the elapsed time in milliseconds."
+    start = time.time()
+    func(*args, **kwargs)
+    return (time.time() - start) * 1000
+
+
+def percentile(values, p):
+    "Returns the ``p``th percentile of ``values`` (nearest rank)."
+    if not values:
+        return None
+    values = sorted(values)
+    index = int(round(p / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+def summarize(timings):
+    "Returns a dict of summary statistics for a list of timings."
+    return {
+        'count': len(timings),
+        'mean': sum(timings) / len(timings) if timings else None,
+        'p50': percentile(timings, 50),
+        'p95': percentile(timings, 95),
+        'p99': percentile(timings, 99),
+        'max': max(timings) if timings else None,
+    }
+
+
+def report(options, results, **summary):
+    """Writes the results as JSON if an output path was given. Keyword
+    arguments are written alongside them, e.g. totals for the whole run.
+    """
+    if options.output:
+        data = {
+            'engine': options.engine,
+            'timestamp': datetime.now().isoformat(),
+            'results': results,
+        }
+        data.update(summary)
+
+        with open(options.output, 'w') as f:
+            json.dump(data, f, indent=4, sort_keys=True)
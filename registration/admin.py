@@ -1,20 +1,67 @@
+from datetime import datetime
+
 from django.contrib import admin
-from django.contrib.sites.models import RequestSite
-from django.contrib.sites.models import Site
-from django.utils.translation import ugettext_lazy as _
+from django.db.models import Q
+from django.utils.translation import ugettext, ugettext_lazy as _
 
+from registration.backends import get_backend, DEFAULT_BACKEND_ALIAS
+from registration.mail import queue_messages
 from registration.models import RegistrationProfile
 
+# number of profiles loaded and rendered at a time by bulk actions
+BATCH_SIZE = 500
+
+
+class ExpiredListFilter(admin.SimpleListFilter):
+    title = _('activation expired')
+    parameter_name = 'expired'
+
+    def lookups(self, request, model_admin):
+        return (
+            ('1', _('Yes')),
+            ('0', _('No')),
+        )
+
+    def queryset(self, request, queryset):
+        now = datetime.now()
+
+        if self.value() == '1':
+            return queryset.filter(expires_at__lte=now)
+        if self.value() == '0':
+            return queryset.filter(Q(expires_at__isnull=True) | Q(expires_at__gt=now))
+        return queryset
+
+
 class RegistrationAdmin(admin.ModelAdmin):
     actions = ('activate_users', 'resend_activation_email')
-    list_display = ('user', 'verified', 'moderated', 'activation_expired')
+    list_display = ('user', 'verified', 'moderated', 'activated', 'activation_expired')
+    list_filter = ('state', 'verified', 'moderated', 'activated', ExpiredListFilter)
     search_fields = ('user__username', 'user__first_name', 'user__last_name')
 
+    # the flags are changed together with the state by the moderation views
+    # and the actions, so they cannot get out of step
+    readonly_fields = ('state', 'verified', 'moderated', 'activated')
+
+    # the user is joined in the changelist query and expiry is read from the
+    # profile's ``expires_at``, so the page takes the same number of queries
+    # regardless of its size
+    list_select_related = True
+
+    def activation_expired(self, profile):
+        return profile.activation_expired()
+
+    activation_expired.boolean = True
+    activation_expired.short_description = _('activation expired')
+    activation_expired.admin_order_field = 'expires_at'
+
     def activate_users(self, request, queryset):
         "Activates the selected users, if they are not already activated."
-        for profile in queryset:
-            inactive_profiles = queryset.exclude(activated=True)
-            RegistrationProfile.objects.activate_user(profile.activation_key)
+        backend = get_backend(DEFAULT_BACKEND_ALIAS)
+
+        count = RegistrationProfile.objects.activate_users(queryset,
+            request=request, backend=backend, batch_size=BATCH_SIZE)
+
+        self.message_user(request, ugettext('{0} users activated.').format(count))
 
     activate_users.short_description = _('Activate users')
 
@@ -25,15 +72,39 @@ class RegistrationAdmin(admin.ModelAdmin):
         who are eligible to activate; emails will not be sent to users
         whose activation keys have expired or who have already
         activated.
+
+        Profiles are loaded in batches and the emails of each batch are
+        handed to the email queue together, like other registration emails.
         """
-        if Site._meta.installed:
-            site = Site.objects.get_current()
-        else:
-            site = RequestSite(request)
-
-        for profile in queryset:
-            if not profile.activation_expired():
-                profile.send_activation_email(site)
+        backend = get_backend(DEFAULT_BACKEND_ALIAS)
+
+        profiles = queryset.select_related('user').order_by('pk')
+        queued = skipped = 0
+        last_pk = 0
+
+        while True:
+            batch = list(profiles.filter(pk__gt=last_pk)[:BATCH_SIZE])
+
+            if not batch:
+                break
+
+            last_pk = batch[-1].pk
+            messages = []
+
+            for profile in batch:
+                if profile.activated or profile.activation_expired():
+                    skipped += 1
+                    continue
+
+                messages.append(backend.get_registration_email(request, profile))
+
+            if messages:
+                queue_messages(messages)
+                queued += len(messages)
+
+        self.message_user(request, ugettext('{0} activation emails queued, {1} '
+            'skipped.').format(queued, skipped))
+
     resend_activation_email.short_description = _('Re-send activation emails')
 
 
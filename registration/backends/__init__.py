@@ -1,20 +1,23 @@
+import threading
+
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 
-# Python 2.7 has an importlib with import_module; for older Pythons,
-# Django's bundled copy provides it.
-try:
-    from importlib import import_module
-except ImportError:
-    from django.utils.importlib import import_module
+from registration.utils import import_path
 
 DEFAULT_BACKEND_ALIAS = 'default'
 
-REGISTRATION_BACKENDS = getattr(settings, 'REGISTRATION_BACKENDS', {
+DEFAULT_BACKENDS = {
     DEFAULT_BACKEND_ALIAS: 'registration.backends.default.Backend',
-})
+}
 
-def get_backend(alias):
+REGISTRATION_BACKENDS = getattr(settings, 'REGISTRATION_BACKENDS', DEFAULT_BACKENDS)
+
+# backend instances by alias, populated on first use
+_backends = {}
+_lock = threading.Lock()
+
+def load_backend(path):
     """Return an instance of a registration backend, given the dotted
     Python import path (as a string) to the backend class.
 
@@ -23,22 +26,62 @@ def get_backend(alias):
     appropriate name), ``django.core.exceptions.ImproperlyConfigured``
     is raised.
     """
-    if not REGISTRATION_BACKENDS.has_key(alias):
-        raise ImproperlyConfigured('No registration backend named "{0}"'.format(alias))
+    try:
+        backend_class = import_path(path)
+    except (ImportError, AttributeError), e:
+        raise ImproperlyConfigured('Error loading registration backend {0}: "{1}"'.format(path, e))
 
-    path = REGISTRATION_BACKENDS[alias]
+    return backend_class()
 
-    i = path.rfind('.')
-    module, attr = path[:i], path[i+1:]
+def load_backends():
+    """Load every backend in ``REGISTRATION_BACKENDS``, if not done already.
 
-    try:
-        mod = import_module(module)
-    except ImportError, e:
-        raise ImproperlyConfigured('Error loading registration backend {0}: "{1}"'.format(module, e))
+    This happens on the first call to ``get_backend``. It can be called at
+    startup, e.g. from the project's urls.py, so configuration errors are
+    raised before any request is served.
+    """
+    if _backends:
+        return
 
-    try:
-        backend_class = getattr(mod, attr)
-    except AttributeError:
-        raise ImproperlyConfigured('Module "{0}" does not define a registration backend named "{1}"'.format(module, attr))
+    with _lock:
+        if not _backends:
+            backends = {}
+            for alias, path in REGISTRATION_BACKENDS.items():
+                backends[alias] = load_backend(path)
+            _backends.update(backends)
 
-    return backend_class()
+def reset_backends():
+    """Discard the loaded backends and re-read ``REGISTRATION_BACKENDS``,
+    e.g. after changing the setting in a test.
+    """
+    global REGISTRATION_BACKENDS
+
+    with _lock:
+        _backends.clear()
+        REGISTRATION_BACKENDS = getattr(settings, 'REGISTRATION_BACKENDS', DEFAULT_BACKENDS)
+
+def get_backend(alias):
+    """Return the registration backend configured for ``alias``.
+
+    Backends are instantiated once per process and shared between requests
+    and threads, so they must not keep per-request state on the instance.
+
+    If no backend is configured for ``alias``,
+    ``django.core.exceptions.ImproperlyConfigured`` is raised.
+    """
+    load_backends()
+
+    if alias not in _backends:
+        raise ImproperlyConfigured('No registration backend named "{0}"'.format(alias))
+
+    return _backends[alias]
+
+def get_backend_alias(backend):
+    """Return the alias under which the ``backend`` instance is configured,
+    or ``None`` if it is not one of the loaded backends.
+    """
+    load_backends()
+
+    for alias, instance in _backends.items():
+        if instance is backend:
+            return alias
@@ -1,188 +1,416 @@
+from datetime import datetime
+
 from django.conf import settings
-from django.db import transaction
-from django.core.mail import send_mail
+from django.core import signing
+from django.core.mail import EmailMessage
 from django.core.urlresolvers import reverse
-from django.template.loader import render_to_string
-from django.contrib.sites.models import Site, RequestSite
+from django.db import connection
 
-from registration import signals
-from registration.forms import RegistrationForm, ModerationForm
-from registration.models import RegistrationProfile
+from registration import signals, ratelimit, metrics
+from registration.deferred import commit_on_success
+from registration.mail import queue_mail, queue_messages, get_site, render_subject, render_message
+from registration.forms import RegistrationForm, ModerationForm, BulkModerationForm
+from registration.managers import SHA1_RE, not_expired
+from registration.models import RegistrationProfile, RegistrationEvent, RegistrationCounter
+from registration.user import User
 
-def send_registration_email(backend, request, profile, **kwargs):
+# namespaces the signatures of activation tokens
+TOKEN_SALT = 'registration.activation'
+
+def get_registration_email(backend, request, profile):
+    "Returns the registration ``EmailMessage`` for ``profile``."
     # get the current site
-    if Site._meta.installed:
-        site = Site.objects.get_current()
-    else:
-        site = RequestSite(request)
+    site = get_site(request)
 
     # send a new user registration email explaining the next steps
-    subject = render_to_string('registration/registration_subject.txt', {
-        'site': site
-    })
-    # no newlines
-    subject = ''.join(subject.splitlines())
+    subject = render_subject('registration/registration_subject.txt', site)
 
-    message = render_to_string('registration/registration_email.txt', {
+    message = render_message('registration/registration_email.txt', {
         'site': site,
         'profile': profile,
+        'activation_key': backend.get_activation_key(request, profile),
         'moderated': backend.moderation_required(request, profile),
         'expiration_days': backend.get_activation_days(request),
     })
 
-    profile.user.email_user(subject, message, settings.DEFAULT_FROM_EMAIL)
+    return EmailMessage(subject, message, settings.DEFAULT_FROM_EMAIL, [profile.user.email])
+
+def send_registration_email(backend, request, profile, **kwargs):
+    queue_messages([get_registration_email(backend, request, profile)])
 
 def send_moderator_email(backend, request, profile):
     # get the current site
-    if Site._meta.installed:
-        site = Site.objects.get_current()
-    else:
-        site = RequestSite(request)
+    site = get_site(request)
 
     # send a new user registration email explaining the next steps
-    subject = render_to_string('registration/moderator_subject.txt', {
-        'site': site
-    })
-
-    # no newlines
-    subject = ''.join(subject.splitlines())
+    subject = render_subject('registration/moderator_subject.txt', site)
 
-    message = render_to_string('registration/moderator_email.txt', {
+    message = render_message('registration/moderator_email.txt', {
         'site': site,
         'profile': profile,
+        'activation_key': backend.get_activation_key(request, profile),
         'expiration_days': backend.get_activation_days(request),
     })
 
     # send an email to all account moderators
     moderators = (x[1] for x in backend.get_moderators(request))
-    send_mail(subject, message, settings.DEFAULT_FROM_EMAIL, moderators)
+    queue_mail(subject, message, settings.DEFAULT_FROM_EMAIL, list(moderators))
 
-def send_acceptance_email(request, profile, **context):
+def get_acceptance_email(request, profile, **context):
+    "Returns the acceptance ``EmailMessage`` for ``profile``."
     # get the current site
-    if Site._meta.installed:
-        site = Site.objects.get_current()
-    else:
-        site = RequestSite(request)
+    site = get_site(request)
 
     # send a new user registration email explaining the next steps
-    subject = render_to_string('registration/acceptance_subject.txt', {
-        'site': site
-    })
-
-    # no newlines
-    subject = ''.join(subject.splitlines())
+    subject = render_subject('registration/acceptance_subject.txt', site)
 
     context.update({
         'site': site,
         'profile': profile,
     })
 
-    message = render_to_string('registration/acceptance_email.txt', context)
+    message = render_message('registration/acceptance_email.txt', context)
 
-    profile.user.email_user(subject, message, settings.DEFAULT_FROM_EMAIL)
+    return EmailMessage(subject, message, settings.DEFAULT_FROM_EMAIL, [profile.user.email])
+
+def send_acceptance_email(request, profile, **context):
+    queue_messages([get_acceptance_email(request, profile, **context)])
 
 
 class Backend(object):
+    def get_registration_email(self, request, profile):
+        "Returns the registration ``EmailMessage`` for ``profile``."
+        return get_registration_email(self, request, profile)
+
     def _send_registration_email(self, *args, **kwargs):
         send_registration_email(self, *args, **kwargs)
 
     def _send_moderator_email(self, *args, **kwargs):
         send_moderator_email(self, *args, **kwargs)
 
+    def get_acceptance_email(self, request, profile, **context):
+        "Returns the acceptance ``EmailMessage`` for ``profile``."
+        return get_acceptance_email(request, profile, **context)
+
     def _send_acceptance_email(self, *args, **kwargs):
         send_acceptance_email(*args, **kwargs)
 
     def get_profile(self, request, activation_key):
-        "Returns a single profile by ``activation_key``."
+        """Returns a single profile by ``activation_key``, which is either
+        the profile's stored key or a signed token. Tokens with a bad
+        signature or which have expired are rejected without a query, as
+        are stored keys known not to exist.
+        """
+        if SHA1_RE.search(activation_key):
+            return RegistrationProfile.objects.get_by_activation_key(activation_key,
+                self.get_profiles(request))
+
+        if self.signed_tokens(request):
+            pk = self.unsign_activation_key(request, activation_key)
+
+            if pk is not None:
+                try:
+                    return self.get_profiles(request).get(pk=pk)
+                except RegistrationProfile.DoesNotExist:
+                    pass
+
+    def get_activation_key(self, request, profile):
+        """Returns the key used in links to verify or moderate ``profile``.
+
+        With signed tokens this encodes the profile's primary key and the
+        current time, signed with the ``SECRET_KEY``. Otherwise it is the
+        profile's stored activation key.
+        """
+        if self.signed_tokens(request):
+            return signing.TimestampSigner(salt=TOKEN_SALT).sign(str(profile.pk))
+        return profile.activation_key
+
+    def unsign_activation_key(self, request, token):
+        """Returns the primary key encoded in a signed token, or ``None`` if
+        the signature is invalid or the token has expired.
+        """
+        activation_days = self.get_activation_days(request)
+        max_age = activation_days * 86400 if activation_days else None
+
         try:
-            return self.get_profiles(request).get(activation_key=activation_key)
-        except RegistrationProfile.DoesNotExist:
-            pass
+            pk = signing.TimestampSigner(salt=TOKEN_SALT).unsign(token, max_age=max_age)
+        except signing.BadSignature:
+            return
+
+        if pk.isdigit():
+            return int(pk)
 
     def get_profiles(self, request, **kwargs):
         "Returns a QuerySet of registration profiles."
         return RegistrationProfile.objects.select_related('user').filter(**kwargs)
 
     def get_unverified_profiles(self, request):
-        "Returns unverified profiles."
+        """Returns unverified profiles. When looked up by state, profiles
+        activated without being verified are not included.
+        """
+        if self.use_profile_state(request):
+            return self.get_profiles(request, state=RegistrationProfile.PENDING)
         return self.get_profiles(request, verified=False)
 
     def get_unmoderated_profiles(self, request):
-        "Returns verified, unmoderated profiles."
-        return self.get_profiles(request, verified=True, moderated=False)
+        """Returns verified, unmoderated profiles whose activation has not
+        expired. When looked up by state, profiles activated without being
+        moderated are not included.
+        """
+        if self.use_profile_state(request):
+            profiles = self.get_profiles(request, state=RegistrationProfile.VERIFIED)
+        else:
+            profiles = self.get_profiles(request, verified=True, moderated=False)
+        return profiles.filter(not_expired())
 
     def get_inactivated_profiles(self, request):
         "Returns verified, non-activated profiles."
+        if self.use_profile_state(request):
+            return self.get_profiles(request, state__in=(RegistrationProfile.VERIFIED,
+                RegistrationProfile.REJECTED, RegistrationProfile.APPROVED))
         return self.get_profiles(request, verified=True, activated=False)
 
-    @transaction.commit_on_success
+    @metrics.timed('register')
+    @commit_on_success
     def register(self, request, form, **kwargs):
         "Post-form validation registration logic."
-        if Site._meta.installed:
-            site = Site.objects.get_current()
-        else:
-            site = RequestSite(request)
+        # the form saves the user so it can handle e.g. username collisions
+        with metrics.timer('register.form_save'):
+            form.instance.is_active = False
+            user = form.save()
 
-        user = form.save(commit=False)
-        user.is_active = False
-        user.save()
+        with metrics.timer('register.create_profile'):
+            profile = RegistrationProfile.objects.create_profile(user,
+                self.get_activation_days(request))
+            RegistrationEvent.objects.record(RegistrationEvent.REGISTERED, [user.pk], self)
 
-        profile = RegistrationProfile.objects.create_profile(user)
+        with metrics.timer('register.email'):
+            self._send_registration_email(request, profile)
 
-        self._send_registration_email(request, profile)
-        signals.user_registered.send(sender=self.__class__, user=user,
-            request=request, backend=self)
+        with metrics.timer('register.signal'):
+            signals.user_registered.send(sender=self.__class__, user=user,
+                request=request, backend=self)
 
         return user
 
-    @transaction.commit_on_success
+    def get_taken_emails(self, request, emails):
+        """Returns the set of ``emails`` already registered, upper-cased,
+        matching case-insensitively like the registration form.
+        """
+        if not emails:
+            return set()
+
+        # with normalized emails, or MySQL's case-insensitive collation, an
+        # exact match is enough and uses the plain index on the column
+        if getattr(settings, 'REGISTRATION_NORMALIZE_EMAIL', False) or connection.vendor == 'mysql':
+            users = User.objects.filter(email__in=emails)
+        else:
+            # the same expression as the ``UPPER(email)`` index on PostgreSQL
+            users = User.objects.extra(where=['UPPER(email) IN ({0})'.format(
+                ', '.join(['%s'] * len(emails)))], params=[email.upper() for email in emails])
+
+        return set(email.upper() for email in users.values_list('email', flat=True))
+
+    @metrics.timed('register_many')
+    @commit_on_success
+    def register_many(self, request, users, send_email=True):
+        """Registers a batch of users at once, e.g. when importing accounts.
+
+        ``users`` is a list of unsaved ``User`` instances. Users whose
+        username or email address is already taken are skipped. The users and
+        their profiles are inserted with one statement each and the
+        registration emails are queued together once the batch commits.
+
+        Returns the list of created profiles.
+        """
+        if getattr(settings, 'REGISTRATION_NORMALIZE_EMAIL', False):
+            for user in users:
+                user.email = user.email.lower()
+
+        taken_usernames = set(User.objects.filter(username__in=[user.username
+            for user in users]).values_list('username', flat=True))
+
+        taken_emails = self.get_taken_emails(request, [user.email
+            for user in users if user.email])
+
+        new_users = []
+
+        for user in users:
+            if user.username in taken_usernames or user.email.upper() in taken_emails:
+                continue
+
+            # guard against duplicates within the batch itself
+            taken_usernames.add(user.username)
+            if user.email:
+                taken_emails.add(user.email.upper())
+
+            user.is_active = False
+            new_users.append(user)
+
+        if not new_users:
+            return []
+
+        User.objects.bulk_create(new_users)
+
+        # bulk inserts do not set primary keys
+        new_users = User.objects.filter(username__in=[user.username for user in new_users])
+
+        RegistrationProfile.objects.create_profiles(new_users,
+            self.get_activation_days(request))
+
+        profiles = list(RegistrationProfile.objects.select_related('user')
+            .filter(user__in=new_users))
+
+        RegistrationEvent.objects.record(RegistrationEvent.REGISTERED,
+            [profile.user_id for profile in profiles], self)
+
+        if send_email:
+            with metrics.timer('register_many.email'):
+                queue_messages([self.get_registration_email(request, profile)
+                    for profile in profiles if profile.user.email])
+
+        with metrics.timer('register_many.signal'):
+            for profile in profiles:
+                signals.user_registered.send(sender=self.__class__, user=profile.user,
+                    request=request, backend=self)
+
+        metrics.incr('register_many.registered', len(profiles))
+
+        return profiles
+
+    @metrics.timed('verify')
+    @commit_on_success
     def verify(self, request, profile, **kwargs):
         """Given an activation key, mark the account as being verified for
         moderation. Send an email to all account moderators on the first
         occurence.
 
-        The status of the verification is returned which denotes whether the
-        verification was successful or the account has already been verified.
+        The profile is marked verified with a conditional ``UPDATE``, so if
+        the link is followed by concurrent requests, only one of them goes on
+        to notify moderators or activate the account. Profiles whose
+        activation has expired are not verified.
         """
-        if not profile.verified:
-            profile.verified = True
-            profile.save()
+        if profile.verified or profile.activation_expired():
+            return
 
-            signals.user_verified.send(sender=self.__class__, user=profile.user,
-                request=request, backend=self)
+        with metrics.timer('verify.save'):
+            verified = RegistrationProfile.objects.transition(profile,
+                RegistrationProfile.VERIFIED, verified=True)
+
+            if verified:
+                RegistrationEvent.objects.record(RegistrationEvent.VERIFIED,
+                    [profile.user_id], self)
+                RegistrationCounter.objects.incr({'verified': 1})
+
+        if verified:
+            with metrics.timer('verify.signal'):
+                signals.user_verified.send(sender=self.__class__, user=profile.user,
+                    request=request, backend=self)
 
             # if moderation is required, email moderators, otherwise activate
             # the user's profile immediately
             if self.moderation_required(request, profile):
-                self._send_moderator_email(request, profile)
+                with metrics.timer('verify.email'):
+                    self._send_moderator_email(request, profile)
             else:
                 self.activate(request, profile, **kwargs)
 
+    @metrics.timed('activate')
+    @commit_on_success
     def activate(self, request, profile, **kwargs):
         """Given an an activation key, look up and activate the user account
         corresponding to that key (if possible).
 
         After successful activation, the signal ``user_activated`` will be
         sent, with the newly activated ``User`` as the keyword argument
-        ``user`` and the class of this backend as the sender.
+        ``user`` and the class of this backend as the sender. It is sent
+        once, even if the profile is activated by concurrent requests.
         """
-        if not profile.activated and not profile.activation_expired():
-            profile.activate()
-            signals.user_activated.send(sender=self.__class__, user=profile.user,
-                request=request, backend=self)
+        if profile.activated or profile.activation_expired():
+            return
+
+        with metrics.timer('activate.save'):
+            activated = profile.activate(backend=self)
 
-    @transaction.commit_on_success
+        if activated:
+            with metrics.timer('activate.signal'):
+                signals.user_activated.send(sender=self.__class__, user=profile.user,
+                    request=request, backend=self)
+
+    @metrics.timed('moderate')
+    @commit_on_success
     def moderate(self, request, form, profile, **kwargs):
-        if not profile.moderated:
-            profile.moderated = True
-            profile.moderator = request.user
-            profile.save()
+        """Records the moderation of ``profile``, activating it if approved,
+        and emails the user. The profile is marked moderated with a
+        conditional ``UPDATE``, so if two moderators act at once, only the
+        first decision is applied and emailed. Only verified profiles whose
+        activation has not expired can be moderated.
+        """
+        if profile.moderated or profile.activation_expired():
+            return
+
+        # XXX ghetto and fragile..
+        approve = form.cleaned_data['status'].lower() == 'approve'
+
+        with metrics.timer('moderate.save'):
+            moderated = RegistrationProfile.objects.transition(profile,
+                RegistrationProfile.APPROVED if approve else RegistrationProfile.REJECTED,
+                moderated=True, moderator=request.user, moderation_time=datetime.now())
+
+            if moderated:
+                RegistrationEvent.objects.record(RegistrationEvent.MODERATED,
+                    [profile.user_id], self)
+                RegistrationCounter.objects.incr({'moderated': 1})
 
-            # XXX ghetto and fragile..
-            if form.cleaned_data['status'].lower() == 'approve':
+        if moderated:
+            if approve:
                 self.activate(request, profile, **kwargs)
 
-            self._send_acceptance_email(request, profile, **form.cleaned_data)
+            with metrics.timer('moderate.email'):
+                self._send_acceptance_email(request, profile, **form.cleaned_data)
+
+    @metrics.timed('moderate_many')
+    def moderate_many(self, request, form, pks, batch_size=500):
+        """Moderates the profiles with the primary keys ``pks`` at once,
+        approving or rejecting them all according to ``form``. Returns the
+        number of profiles moderated.
+
+        Profiles are moderated and activated with a few ``UPDATE`` statements
+        per batch of ``batch_size``, each batch in its own transaction.
+        Profiles which have expired or have been moderated or activated
+        already, including by a concurrent request, are skipped. The
+        acceptance emails are queued together once all batches have
+        committed, so they are sent over a single mail connection.
+        """
+        approve = form.cleaned_data['status'].lower() == 'approve'
+        context = dict(form.cleaned_data)
+        context.pop('profiles', None)
+
+        pks = sorted(set(pks))
+        messages = []
+        moderated = 0
+
+        for i in xrange(0, len(pks), batch_size):
+            with metrics.timer('moderate_many.save'):
+                moderated_pks, _ = RegistrationProfile.objects.moderate_profiles(
+                    self.get_profiles(request, pk__in=pks[i:i + batch_size]),
+                    request.user, approve, request=request, backend=self,
+                    batch_size=batch_size)
+
+            if not moderated_pks:
+                continue
+
+            moderated += len(moderated_pks)
+            profiles = self.get_profiles(request, pk__in=moderated_pks).order_by('pk')
+
+            messages.extend(self.get_acceptance_email(request, profile, **context)
+                for profile in profiles if profile.user.email)
+
+        if messages:
+            with metrics.timer('moderate_many.email'):
+                queue_messages(messages)
+
+        return moderated
 
     def registration_allowed(self, request):
         """
@@ -199,6 +427,34 @@ class Backend(object):
         """
         return getattr(settings, 'REGISTRATION_OPEN', True)
 
+    def registration_attempt_allowed(self, request):
+        """Indicate whether a registration attempt (POST) may be processed,
+        based on the ``register`` rate limit per IP address and the
+        ``register_email`` rate limit per email address, so rejected requests
+        never reach the database.
+        """
+        if request.method != 'POST':
+            return True
+
+        if not ratelimit.allow('register', ratelimit.get_client_ip(request)):
+            return False
+
+        email = request.POST.get('email')
+        if email and not ratelimit.allow('register_email', email.lower()):
+            return False
+
+        return True
+
+    def verification_allowed(self, request):
+        """Indicate whether a verification link may be looked up, based on
+        the ``verify`` rate limit per IP address.
+        """
+        return ratelimit.allow('verify', ratelimit.get_client_ip(request))
+
+    def signed_tokens(self, request):
+        "Indicate whether links carry signed tokens rather than stored keys."
+        return getattr(settings, 'REGISTRATION_SIGNED_TOKENS', False)
+
     def moderation_required(self, request, profile=None):
         "Indicate whether account moderation is enabled."
         return getattr(settings, 'REGISTRATION_MODERATION', False)
@@ -207,9 +463,19 @@ class Backend(object):
         "Returns a tuple of moderators."
         return getattr(settings, 'REGISTRATION_MODERATORS', settings.MANAGERS)
 
+    def use_profile_state(self, request):
+        """Indicate whether the queues of profiles are looked up by the
+        profile's state rather than its flags.
+        """
+        return getattr(settings, 'REGISTRATION_PROFILE_STATE', False)
+
+    def get_moderation_page_size(self, request):
+        "Returns the number of profiles shown per page of the moderation queue."
+        return getattr(settings, 'REGISTRATION_MODERATION_PAGE_SIZE', 50)
+
     def get_activation_days(self, request):
         "Returns the number of days allowed for activation"
-        return getattr(self, 'REGISTRATION_ACTIVATION_DAYS', 0)
+        return getattr(settings, 'REGISTRATION_ACTIVATION_DAYS', 0)
 
     def get_registration_form_class(self, request):
         "Return the form class used for user registration."
@@ -219,10 +485,18 @@ class Backend(object):
         "Return the form class used for user moderation."
         return ModerationForm
 
+    def get_bulk_moderation_form_class(self, request):
+        "Return the form class used for moderating several users at once."
+        return BulkModerationForm
+
     def post_registration_redirect(self, request, user):
         "Return the ``reverse`` arguments for post-registration."
         return reverse('registration-complete')
 
+    def registration_closed_redirect(self, request):
+        "Return the ``redirect`` arguments when registration is not allowed."
+        return ('registration-disabled',)
+
     def post_moderation_redirect(self, request, user):
         "Return the ``reverse` arguments for post-moderation."
         return reverse('moderate-registration-list')
@@ -0,0 +1,59 @@
+"""Deferring work until the surrounding transaction has committed.
+
+Side effects of a registration step such as sending email must not happen
+if the step is rolled back, and should not hold the transaction open while
+they run. Backend methods are wrapped with ``commit_on_success`` from this
+module and side effects are registered with ``on_commit``.
+"""
+import threading
+from functools import wraps
+
+from django.db import transaction
+
+_state = threading.local()
+
+
+def on_commit(func, *args, **kwargs):
+    """Calls ``func`` with the given arguments once the outermost
+    ``commit_on_success`` block of this thread has committed. If no block is
+    active, ``func`` is called immediately.
+    """
+    if getattr(_state, 'depth', 0):
+        _state.callbacks.append((func, args, kwargs))
+    else:
+        func(*args, **kwargs)
+
+
+def commit_on_success(func):
+    """Wraps ``func`` with ``django.db.transaction.commit_on_success`` and
+    calls the functions deferred with ``on_commit`` after it returns. They are
+    discarded if an exception is raised.
+    """
+    func = transaction.commit_on_success(func)
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        depth = getattr(_state, 'depth', 0)
+
+        if not depth:
+            _state.callbacks = []
+
+        _state.depth = depth + 1
+
+        try:
+            result = func(*args, **kwargs)
+        except:
+            if not depth:
+                _state.callbacks = []
+            raise
+        finally:
+            _state.depth = depth
+
+        if not depth:
+            callbacks, _state.callbacks = _state.callbacks, []
+            for callback, args, kwargs in callbacks:
+                callback(*args, **kwargs)
+
+        return result
+
+    return wrapper
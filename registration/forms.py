@@ -1,7 +1,8 @@
 from django import forms
+from django.conf import settings
 from django.utils.translation import ugettext_lazy as _
 from django.contrib.auth import authenticate, forms as auth_forms
-from registration.utils import generate_random_username
+from registration.utils import generate_random_username, save_with_random_username
 
 from registration.user import User
 
@@ -29,11 +30,18 @@ class RegistrationForm(auth_forms.UserCreationForm):
 
     def clean_email(self):
         email = self.cleaned_data.get('email')
-        try:
-            User.objects.get(email__iexact=email)
-        except User.DoesNotExist:
-            return email
-        raise forms.ValidationError(_('An account is already registered with this email address.'))
+
+        # with normalized emails all addresses are stored in lower case, so
+        # an exact match can use a plain index on the column
+        if getattr(settings, 'REGISTRATION_NORMALIZE_EMAIL', False):
+            email = email.lower()
+            users = User.objects.filter(email=email)
+        else:
+            users = User.objects.filter(email__iexact=email)
+
+        if users.exists():
+            raise forms.ValidationError(_('An account is already registered with this email address.'))
+        return email
 
 
 class EmailOnlyRegistrationForm(RegistrationForm):
@@ -48,7 +56,7 @@ class EmailOnlyRegistrationForm(RegistrationForm):
         user = super(EmailOnlyRegistrationForm, self).save(commit=False)
         user.username = generate_random_username()
         if commit:
-            user.save()
+            save_with_random_username(user)
         return user
 
 
@@ -77,3 +85,30 @@ class EmailAuthenticationForm(auth_forms.AuthenticationForm):
 class ModerationForm(forms.Form):
     status = forms.CharField()
     comment = forms.CharField(widget=forms.Textarea, required=False)
+
+
+class ProfilesField(forms.Field):
+    """A list of profile primary keys. The keys are not checked against the
+    database, since profiles which cannot be moderated are skipped anyway.
+    """
+    widget = forms.MultipleHiddenInput
+
+    def to_python(self, value):
+        if not value:
+            return []
+        try:
+            return [int(pk) for pk in value]
+        except (TypeError, ValueError):
+            raise forms.ValidationError(_('Select valid registrations.'))
+
+
+class BulkModerationForm(ModerationForm):
+    profiles = ProfilesField(error_messages={
+        'required': _('Select the registrations to moderate.'),
+    })
+
+    def clean_status(self):
+        status = self.cleaned_data['status']
+        if status.lower() not in ('approve', 'reject'):
+            raise forms.ValidationError(_('Choose to approve or reject the registrations.'))
+        return status
@@ -0,0 +1,60 @@
+"""Caching of activation key lookups.
+
+Keys which match no profile are remembered, so repeated lookups of bad or
+deleted keys, e.g. by link scanners, do not reach the database. The primary
+keys of found profiles are remembered too, so they are fetched by primary
+key. Entries are kept in the cache named by ``REGISTRATION_KEY_CACHE``
+(``None`` disables caching) for ``REGISTRATION_KEY_CACHE_TIMEOUT`` seconds,
+and are invalidated when profiles are created, activated or deleted.
+"""
+from django.conf import settings
+from django.core.cache import get_cache
+
+REGISTRATION_KEY_CACHE = getattr(settings, 'REGISTRATION_KEY_CACHE', 'default')
+
+REGISTRATION_KEY_CACHE_TIMEOUT = getattr(settings, 'REGISTRATION_KEY_CACHE_TIMEOUT', 3600)
+
+# stored for keys without a profile; primary keys are never 0
+MISSING = 0
+
+_cache = None
+
+def get_cache_backend():
+    global _cache
+
+    if _cache is None and REGISTRATION_KEY_CACHE:
+        _cache = get_cache(REGISTRATION_KEY_CACHE)
+
+    return _cache
+
+
+def make_key(activation_key):
+    return 'registration.key.{0}'.format(activation_key)
+
+
+def get(activation_key):
+    """Returns the primary key of the profile with ``activation_key``,
+    ``MISSING`` if there is none or ``None`` if it is not known.
+    """
+    cache = get_cache_backend()
+    if cache is not None:
+        return cache.get(make_key(activation_key))
+
+
+def set_pk(activation_key, pk):
+    "Remembers the primary key of the profile with ``activation_key``."
+    cache = get_cache_backend()
+    if cache is not None:
+        cache.set(make_key(activation_key), pk, REGISTRATION_KEY_CACHE_TIMEOUT)
+
+
+def set_missing(activation_key):
+    "Remembers that there is no profile with ``activation_key``."
+    set_pk(activation_key, MISSING)
+
+
+def invalidate(activation_keys):
+    "Forgets what is known about ``activation_keys``."
+    cache = get_cache_backend()
+    if cache is not None:
+        cache.delete_many([make_key(key) for key in activation_keys])
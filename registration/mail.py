@@ -0,0 +1,260 @@
+"""Delivery of the emails sent during registration.
+
+Emails are handed to a queue only after the surrounding transaction has
+committed, so requests never wait on the mail server while holding a
+transaction open. The queue is set with ``REGISTRATION_EMAIL_QUEUE``:
+
+* ``registration.mail.DatabaseQueue`` (default) stores emails in a table.
+  They are delivered by running the ``sendregistrationemail`` command.
+* ``registration.mail.ThreadQueue`` delivers emails on a pool of threads
+  within the web process.
+* ``registration.mail.ImmediateQueue`` sends emails right away, which is
+  mostly useful during development.
+
+Failed deliveries are retried up to ``REGISTRATION_EMAIL_MAX_ATTEMPTS``
+times, waiting ``REGISTRATION_EMAIL_RETRY_DELAY`` seconds before the first
+retry and twice as long before each one after that.
+
+Email templates are compiled once per process and subjects, which only
+depend on the site, are rendered once per site and language. Call
+``clear_cache`` after changing templates at runtime.
+"""
+import time
+import logging
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.mail import EmailMessage, get_connection
+from django.db.models.signals import post_save, post_delete
+from django.template import Context
+from django.template.loader import get_template
+from django.utils.translation import get_language
+from django.contrib.sites.models import Site, RequestSite
+
+from registration import deferred, metrics
+from registration.models import QueuedEmail
+from registration.utils import import_path
+from registration.workers import ThreadPool, claim, retry, retry_delay
+
+logger = logging.getLogger(__name__)
+
+REGISTRATION_EMAIL_QUEUE = getattr(settings, 'REGISTRATION_EMAIL_QUEUE',
+    'registration.mail.DatabaseQueue')
+
+REGISTRATION_EMAIL_MAX_ATTEMPTS = getattr(settings, 'REGISTRATION_EMAIL_MAX_ATTEMPTS', 5)
+
+REGISTRATION_EMAIL_RETRY_DELAY = getattr(settings, 'REGISTRATION_EMAIL_RETRY_DELAY', 60)
+
+REGISTRATION_EMAIL_WORKERS = getattr(settings, 'REGISTRATION_EMAIL_WORKERS', 2)
+
+
+_templates = {}
+_subjects = {}
+
+
+def get_site(request):
+    """Returns the current site. ``Site`` instances are cached by the sites
+    framework itself, so this is free after the first call.
+    """
+    if Site._meta.installed:
+        return Site.objects.get_current()
+    return RequestSite(request)
+
+
+def render_message(template_name, context):
+    "Renders an email template, compiling it on first use."
+    if template_name not in _templates:
+        _templates[template_name] = get_template(template_name)
+    return _templates[template_name].render(Context(context))
+
+
+def render_subject(template_name, site):
+    """Renders a subject template with no newlines. Subject templates only
+    receive the ``site``, so the result is cached per site and language.
+    """
+    key = (template_name, site.domain, site.name, get_language())
+
+    if key not in _subjects:
+        subject = render_message(template_name, {'site': site})
+        _subjects[key] = ''.join(subject.splitlines())
+
+    return _subjects[key]
+
+
+def clear_cache(**kwargs):
+    "Clears the cached templates, subjects and sites."
+    _templates.clear()
+    _subjects.clear()
+    Site.objects.clear_cache()
+
+# subjects embed the site's name and domain
+post_save.connect(clear_cache, sender=Site, dispatch_uid='registration.mail')
+post_delete.connect(clear_cache, sender=Site, dispatch_uid='registration.mail')
+
+
+class BaseQueue(object):
+    "Interface for email queues."
+    def enqueue(self, messages):
+        "Accepts a list of ``EmailMessage`` instances for delivery."
+        raise NotImplementedError
+
+
+class ImmediateQueue(BaseQueue):
+    "Sends messages right away over a single connection."
+    def enqueue(self, messages):
+        with metrics.timer('mail.send'):
+            get_connection().send_messages(messages)
+
+
+class ThreadQueue(BaseQueue):
+    """Sends messages on a pool of background threads within the process.
+
+    Messages which have not been sent are lost if the process exits.
+    """
+    def __init__(self, workers=REGISTRATION_EMAIL_WORKERS):
+        self.pool = ThreadPool(workers)
+
+    def enqueue(self, messages):
+        self.pool.submit(self.deliver, list(messages))
+
+    def deliver(self, messages):
+        """Sends ``messages`` over a single connection. Messages which fail
+        do not hold up the others; they are retried once the rest have been
+        sent, each up to ``REGISTRATION_EMAIL_MAX_ATTEMPTS`` times.
+        """
+        for attempt in xrange(1, REGISTRATION_EMAIL_MAX_ATTEMPTS + 1):
+            messages = self.send(messages, attempt)
+
+            if not messages:
+                return
+
+            if attempt < REGISTRATION_EMAIL_MAX_ATTEMPTS:
+                time.sleep(retry_delay(REGISTRATION_EMAIL_RETRY_DELAY, attempt))
+
+        logger.error('Giving up sending {0} registration emails'.format(len(messages)))
+
+    def send(self, messages, attempt):
+        "Attempts to send each of ``messages``, returning those which failed."
+        connection = get_connection()
+        failed = []
+
+        try:
+            connection.open()
+        except Exception:
+            logger.exception('Error connecting to the mail server (attempt {0})'.format(attempt))
+            return messages
+
+        try:
+            for i, message in enumerate(messages):
+                try:
+                    with metrics.timer('mail.send'):
+                        connection.send_messages([message])
+                except Exception:
+                    logger.exception('Error sending registration email to {0} '
+                        '(attempt {1})'.format(', '.join(message.recipients()), attempt))
+                    failed.append(message)
+
+                    # the connection may be unusable after an error
+                    connection.close()
+                    try:
+                        connection.open()
+                    except Exception:
+                        return failed + messages[i + 1:]
+        finally:
+            connection.close()
+
+        return failed
+
+
+class DatabaseQueue(BaseQueue):
+    """Stores messages in the ``QueuedEmail`` table. They are delivered by a
+    worker process calling ``process``, e.g. the ``sendregistrationemail``
+    management command.
+
+    Emails are claimed by a worker for ``lease`` seconds, so several workers
+    can process the queue at the same time.
+    """
+    def __init__(self, lease=300):
+        self.lease = lease
+
+    def enqueue(self, messages):
+        QueuedEmail.objects.bulk_create([QueuedEmail(subject=message.subject,
+            body=message.body, from_email=message.from_email,
+            recipients='\n'.join(message.recipients())) for message in messages])
+
+    def process(self, batch_size=100):
+        """Delivers up to ``batch_size`` due emails over a single connection.
+        Returns a tuple of the number of emails sent and failed.
+        """
+        pks = claim(QueuedEmail.objects.all(), batch_size,
+            REGISTRATION_EMAIL_MAX_ATTEMPTS, self.lease)
+        emails = list(QueuedEmail.objects.filter(pk__in=pks))
+
+        if not emails:
+            return 0, 0
+
+        connection = get_connection()
+
+        try:
+            connection.open()
+        except Exception, e:
+            for email in emails:
+                self.retry(email, e)
+            return 0, len(emails)
+
+        sent = []
+        failed = 0
+
+        try:
+            for email in emails:
+                try:
+                    with metrics.timer('mail.send'):
+                        connection.send_messages([email.message()])
+                    sent.append(email.pk)
+                except Exception, e:
+                    failed += 1
+                    self.retry(email, e)
+        finally:
+            connection.close()
+
+        QueuedEmail.objects.filter(pk__in=sent).delete()
+
+        return len(sent), failed
+
+    def retry(self, email, error):
+        "Schedules ``email`` for another attempt after a failed delivery."
+        logger.warning('Error sending registration email {0}: {1}'.format(email.pk, error))
+        retry(email, error, REGISTRATION_EMAIL_RETRY_DELAY)
+
+
+_queue = None
+
+def get_queue():
+    "Returns the email queue configured by ``REGISTRATION_EMAIL_QUEUE``."
+    global _queue
+
+    if _queue is None:
+        try:
+            queue_class = import_path(REGISTRATION_EMAIL_QUEUE)
+        except (ImportError, AttributeError), e:
+            raise ImproperlyConfigured('Error loading email queue {0}: "{1}"'.format(REGISTRATION_EMAIL_QUEUE, e))
+
+        _queue = queue_class()
+
+    return _queue
+
+
+def enqueue(messages):
+    "Hands ``messages`` to the email queue right away."
+    with metrics.timer('mail.enqueue'):
+        get_queue().enqueue(messages)
+
+
+def queue_messages(messages):
+    "Queues ``messages`` for delivery once the current transaction commits."
+    deferred.on_commit(enqueue, list(messages))
+
+
+def queue_mail(subject, message, from_email, recipient_list):
+    "Counterpart to ``django.core.mail.send_mail`` which queues the email."
+    queue_messages([EmailMessage(subject, message, from_email, recipient_list)])
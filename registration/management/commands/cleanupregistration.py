@@ -6,6 +6,7 @@ Calls ``RegistrationProfile.objects.delete_expired_users()``, which
 contains the actual logic for determining which accounts are deleted.
 
 """
+from optparse import make_option
 
 from django.core.management.base import NoArgsCommand
 
@@ -15,5 +16,24 @@ from registration.models import RegistrationProfile
 class Command(NoArgsCommand):
     help = "Delete expired user registrations from the database"
 
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', action='store', type='int', dest='batch_size',
+            default=1000, help='Number of accounts deleted per transaction.'),
+        make_option('--dry-run', action='store_true', dest='dry_run',
+            default=False, help='Only report the number of expired accounts.'),
+        make_option('--max-runtime', action='store', type='float', dest='max_runtime',
+            default=None, help='Stop starting new batches after this many seconds.'),
+    )
+
     def handle_noargs(self, **options):
-        RegistrationProfile.objects.delete_expired_users()
+        dry_run = options['dry_run']
+
+        count = RegistrationProfile.objects.delete_expired_users(
+            batch_size=options['batch_size'], dry_run=dry_run,
+            max_runtime=options['max_runtime'])
+
+        if int(options['verbosity']) > 0:
+            if dry_run:
+                self.stdout.write('{0} expired registrations would be deleted\n'.format(count))
+            else:
+                self.stdout.write('{0} expired registrations deleted\n'.format(count))
@@ -0,0 +1,112 @@
+"""
+A management command which registers users in bulk from a CSV or JSON
+lines file, e.g. when onboarding the accounts of a partner organization.
+
+Each record provides ``email`` and optionally ``username``, ``first_name``,
+``last_name`` and ``password``. Records without a username are given a
+random one. The file is read as a stream and registered in batches with
+``Backend.register_many``, which queues the registration emails.
+
+"""
+import csv
+import sys
+import time
+import json
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from registration.backends import get_backend, DEFAULT_BACKEND_ALIAS
+from registration.user import User
+from registration.utils import generate_random_username
+
+FIELDS = ('username', 'email', 'first_name', 'last_name')
+
+
+def read_csv(f):
+    for row in csv.DictReader(f):
+        yield dict((key, value.decode('utf-8')) for key, value in row.items() if value)
+
+
+def read_jsonl(f):
+    for line in f:
+        if line.strip():
+            yield json.loads(line)
+
+
+READERS = {
+    'csv': read_csv,
+    'jsonl': read_jsonl,
+}
+
+
+class Command(BaseCommand):
+    args = '<path>'
+    help = "Register users in bulk from a CSV or JSON lines file ('-' for stdin)"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format', action='store', dest='format', default=None,
+            help='Either csv or jsonl. Defaults to the extension of the file.'),
+        make_option('--batch-size', action='store', type='int', dest='batch_size',
+            default=1000, help='Number of users registered per transaction.'),
+        make_option('--backend', action='store', dest='backend',
+            default=DEFAULT_BACKEND_ALIAS, help='Alias of the registration backend.'),
+        make_option('--no-email', action='store_false', dest='send_email',
+            default=True, help='Do not queue registration emails.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Exactly one path is required')
+
+        path = args[0]
+
+        format = options['format'] or path.rsplit('.', 1)[-1]
+
+        if format not in READERS:
+            raise CommandError('Unknown format "{0}", use --format'.format(format))
+
+        backend = get_backend(options['backend'])
+        verbosity = int(options['verbosity'])
+
+        f = sys.stdin if path == '-' else open(path)
+
+        start = time.time()
+        read = registered = 0
+
+        try:
+            records = READERS[format](f)
+
+            while True:
+                users = [self.build_user(record) for record in
+                    (next(records, None) for i in xrange(options['batch_size']))
+                    if record is not None]
+
+                if not users:
+                    break
+
+                profiles = backend.register_many(None, users,
+                    send_email=options['send_email'])
+
+                read += len(users)
+                registered += len(profiles)
+
+                if verbosity > 0:
+                    self.stdout.write('{0} registered, {1} skipped, {2:.0f} records/s\n'.format(
+                        registered, read - registered, read / (time.time() - start)))
+        finally:
+            if f is not sys.stdin:
+                f.close()
+
+    def build_user(self, record):
+        user = User(**dict((key, record[key]) for key in FIELDS if record.get(key)))
+
+        if not user.username:
+            user.username = generate_random_username()
+
+        if record.get('password'):
+            user.set_password(record['password'])
+        else:
+            user.set_unusable_password()
+
+        return user
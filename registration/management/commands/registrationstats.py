@@ -0,0 +1,38 @@
+"""
+A management command which prints the number of registration profiles in
+each stage, read from the maintained counters rather than counted.
+
+Use ``--rebuild`` to recount the profiles first, e.g. after profiles have
+been changed or deleted outside of the registration backend.
+
+"""
+import json
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from registration.models import RegistrationCounter
+
+
+class Command(NoArgsCommand):
+    help = "Print the number of registrations in each stage"
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--rebuild', action='store_true', dest='rebuild',
+            default=False, help='Recount the profiles in a single pass first.'),
+        make_option('--json', action='store_true', dest='json',
+            default=False, help='Print the counts as JSON.'),
+    )
+
+    def handle_noargs(self, **options):
+        if options['rebuild']:
+            counts = RegistrationCounter.objects.rebuild()
+        else:
+            counts = RegistrationCounter.objects.get_counts()
+
+        if options['json']:
+            self.stdout.write(json.dumps(counts) + '\n')
+            return
+
+        for name in RegistrationCounter.NAMES + ('pending',):
+            self.stdout.write('{0}: {1}\n'.format(name, counts[name]))
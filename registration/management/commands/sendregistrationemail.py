@@ -0,0 +1,50 @@
+"""
+A management command which delivers the registration emails stored by
+``registration.mail.DatabaseQueue``.
+
+Run it periodically, e.g. from cron, or continuously with ``--loop``.
+
+"""
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+from registration.mail import get_queue
+
+
+class Command(NoArgsCommand):
+    help = "Deliver queued registration emails"
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', action='store', type='int', dest='batch_size',
+            default=100, help='Number of emails sent per connection.'),
+        make_option('--loop', action='store_true', dest='loop',
+            default=False, help='Keep polling the queue for new emails.'),
+        make_option('--interval', action='store', type='float', dest='interval',
+            default=5, help='Seconds to wait between polls when the queue is empty.'),
+    )
+
+    def handle_noargs(self, **options):
+        queue = get_queue()
+
+        if not hasattr(queue, 'process'):
+            raise CommandError('The configured email queue ({0}) is not processed '
+                'by a worker'.format(queue.__class__.__name__))
+
+        verbosity = int(options['verbosity'])
+
+        while True:
+            sent, failed = queue.process(batch_size=options['batch_size'])
+
+            if verbosity > 1 or (verbosity > 0 and (sent or failed)):
+                self.stdout.write('{0} emails sent, {1} failed\n'.format(sent, failed))
+
+            # keep going while there is a backlog
+            if sent or failed:
+                continue
+
+            if not options['loop']:
+                break
+
+            time.sleep(options['interval'])
@@ -0,0 +1,44 @@
+"""
+A management command which delivers the registration signals recorded for
+receivers connected with the ``outbox`` mode.
+
+Run it periodically, e.g. from cron, or continuously with ``--loop``.
+
+"""
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from registration.signals import deliver_pending
+
+
+class Command(NoArgsCommand):
+    help = "Deliver pending registration signals to outbox receivers"
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', action='store', type='int', dest='batch_size',
+            default=100, help='Number of signals claimed at a time.'),
+        make_option('--loop', action='store_true', dest='loop',
+            default=False, help='Keep polling for new signals.'),
+        make_option('--interval', action='store', type='float', dest='interval',
+            default=5, help='Seconds to wait between polls when none are pending.'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options['verbosity'])
+
+        while True:
+            delivered, failed = deliver_pending(batch_size=options['batch_size'])
+
+            if verbosity > 1 or (verbosity > 0 and (delivered or failed)):
+                self.stdout.write('{0} signals delivered, {1} failed\n'.format(delivered, failed))
+
+            # keep going while there is a backlog
+            if delivered or failed:
+                continue
+
+            if not options['loop']:
+                break
+
+            time.sleep(options['interval'])
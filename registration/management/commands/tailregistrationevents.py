@@ -0,0 +1,67 @@
+"""
+A management command which writes registration events to standard output as
+JSON lines, e.g. to feed them to another system.
+
+With ``--consumer``, reading resumes after the last event acknowledged by
+the named consumer, along with events which committed late, and each batch
+is acknowledged once it has been written.
+Otherwise events are read after ``--after`` and nothing is acknowledged.
+Use ``--follow`` to keep waiting for new events.
+
+"""
+import json
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from registration.models import RegistrationEvent, RegistrationEventConsumer
+
+
+class Command(NoArgsCommand):
+    help = "Write registration events to standard output as JSON lines"
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--consumer', action='store', dest='consumer', default=None,
+            help='Name of the consumer whose position is read and acknowledged.'),
+        make_option('--after', action='store', type='int', dest='after',
+            default=0, help='Read events after this id, without a consumer.'),
+        make_option('--batch-size', action='store', type='int', dest='batch_size',
+            default=100, help='Number of events read at a time.'),
+        make_option('--follow', action='store_true', dest='follow',
+            default=False, help='Keep polling for new events.'),
+        make_option('--interval', action='store', type='float', dest='interval',
+            default=1, help='Seconds to wait between polls when there are no new events.'),
+    )
+
+    def handle_noargs(self, **options):
+        consumer = None
+        position = options['after']
+
+        if options['consumer']:
+            consumer, created = RegistrationEventConsumer.objects\
+                .get_or_create(name=options['consumer'])
+            position = consumer.position
+
+        while True:
+            if consumer is not None:
+                events = consumer.read(options['batch_size'])
+            else:
+                events = RegistrationEvent.objects.after(position, options['batch_size'])
+
+            for event in events:
+                self.stdout.write(json.dumps(event.as_dict()) + '\n')
+
+            if events:
+                self.stdout.flush()
+                position = events[-1].pk
+
+                if consumer is not None:
+                    consumer.ack(events[-1])
+
+                continue
+
+            if not options['follow']:
+                break
+
+            time.sleep(options['interval'])
@@ -1,10 +1,20 @@
 import re
+import time
 import random
 import hashlib
-from django.db import models
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.db import connection, models, transaction, IntegrityError
+
+from registration import deferred, signals, keycache
+from registration.user import User
 
 SHA1_RE = re.compile('^[a-f0-9]{40}$')
 
+def not_expired(now=None):
+    "Returns a ``Q`` matching profiles whose activation has not expired."
+    return models.Q(expires_at__isnull=True) | models.Q(expires_at__gt=now or datetime.now())
+
 class RegistrationManager(models.Manager):
     """Custom manager for the ``RegistrationProfile`` model.
 
@@ -27,21 +37,234 @@ class RegistrationManager(models.Manager):
         # Make sure the key we're trying conforms to the pattern of a
         # SHA1 hash; if it doesn't, no point trying to look it up in
         # the database.
-        if SHA1_RE.search(activation_key):
-            try:
-                profile = self.get(activation_key=activation_key)
-            except self.model.DoesNotExist:
-                return
+        profile = self.get_by_activation_key(activation_key)
 
+        if profile:
             return profile.activate()
 
-    def create_profile(self, user):
-        """Create a ``RegistrationProfile`` for a given ``User``, and return
-        the ``RegistrationProfile``.
+    def get_by_activation_key(self, activation_key, queryset=None):
+        """Return the profile with ``activation_key`` from ``queryset``
+        (defaulting to all profiles), or ``None`` if there is none.
 
-        The activation key for the ``RegistrationProfile`` will be a SHA1 hash,
-        generated from a combination of the ``User``'s username and a random
-        salt.
+        Keys which are not shaped like a SHA1 hash are rejected right away.
+        Lookups are cached (see ``registration.keycache``), so repeated
+        lookups of unknown keys do not query the database and known keys
+        are fetched by primary key.
+        """
+        # Make sure the key we're trying conforms to the pattern of a
+        # SHA1 hash; if it doesn't, no point trying to look it up in
+        # the database.
+        if not SHA1_RE.search(activation_key):
+            return
+
+        pk = keycache.get(activation_key)
+
+        if pk == keycache.MISSING:
+            return
+
+        profiles = self.all() if queryset is None else queryset
+
+        try:
+            if pk is None:
+                profile = profiles.get(activation_key=activation_key)
+            else:
+                profile = profiles.get(pk=pk)
+        except self.model.DoesNotExist:
+            # a filtered queryset may exclude a profile which does exist
+            if queryset is None or not self.filter(activation_key=activation_key).exists():
+                keycache.set_missing(activation_key)
+            return
+
+        if pk is None:
+            keycache.set_pk(activation_key, profile.pk)
+
+        return profile
+
+    def bulk_create(self, profiles):
+        """Inserts ``profiles`` with a single ``INSERT``, setting their state
+        from their flags first like ``save`` does.
+        """
+        for profile in profiles:
+            profile.state = profile.get_state()
+        return super(RegistrationManager, self).bulk_create(profiles)
+
+    def transition(self, profile, state, **fields):
+        """Moves ``profile`` to ``state``, also setting ``fields``, with a
+        single ``UPDATE`` conditioned on the profile still being in a state
+        it may move from. Of concurrent calls, e.g. from a double-clicked
+        link, only one succeeds. Returns whether the profile was moved, in
+        which case the instance is updated as well.
+        """
+        # saves the query when e.g. an activated profile is activated again
+        if not profile.can_transition(state):
+            return False
+
+        updated = self.filter(pk=profile.pk, state__in=self.model.get_source_states(state))\
+            .update(state=state, **fields)
+
+        if not updated:
+            return False
+
+        profile.state = state
+        for name, value in fields.items():
+            setattr(profile, name, value)
+
+        return True
+
+    def sync_states(self, profiles=None):
+        """Sets the state of the ``profiles`` queryset (defaulting to all
+        profiles) from their flags, e.g. after the flags have been updated
+        directly rather than with ``transition``. Approved profiles whose
+        flags still match are left approved.
+        """
+        model = self.model
+
+        if profiles is None:
+            profiles = self.all()
+
+        profiles.filter(activated=True).update(state=model.ACTIVATED)
+        profiles.filter(activated=False, verified=False).update(state=model.PENDING)
+        profiles.filter(activated=False, verified=True, moderated=False)\
+            .update(state=model.VERIFIED)
+        profiles.filter(activated=False, verified=True, moderated=True)\
+            .exclude(state=model.APPROVED).update(state=model.REJECTED)
+
+    def activate_users(self, profiles, request=None, backend=None, batch_size=500):
+        """Activate the users of the ``RegistrationProfile`` queryset
+        ``profiles`` which are not activated yet, returning the number of
+        users activated.
+
+        Users and profiles are updated with one ``UPDATE`` each per batch of
+        ``batch_size`` profiles. ``user_activated`` is sent for the users of
+        a batch with ``send_many``, so outbox receivers are recorded in the
+        batch's transaction and other receivers are called once it has
+        committed. The users are not saved one by one, so their ``pre_save``
+        and ``post_save`` signals are not sent.
+        """
+        pending = profiles.filter(activated=False).order_by('pk')\
+            .values_list('pk', 'user', 'activation_key')
+
+        sender = backend.__class__ if backend else self.model
+        activated = 0
+        last_pk = 0
+
+        while True:
+            batch = list(pending.filter(pk__gt=last_pk)[:batch_size])
+
+            if not batch:
+                break
+
+            last_pk = batch[-1][0]
+            pks, user_pks, activation_keys = zip(*batch)
+
+            activated += self._activate_users(pks, sender, request, backend)
+            keycache.invalidate(activation_keys)
+
+        return activated
+
+    @deferred.commit_on_success
+    def _activate_users(self, pks, sender, request=None, backend=None):
+        """Activates the profiles with the primary keys ``pks`` which can still
+        be activated, returning the number activated.
+        """
+        from registration.models import RegistrationEvent, RegistrationCounter
+
+        # profiles activated by a concurrent request are excluded once the
+        # lock is acquired, since their state no longer matches
+        batch = list(self.select_for_update().filter(pk__in=pks,
+            state__in=self.model.get_source_states(self.model.ACTIVATED))
+            .values_list('pk', 'user'))
+
+        if not batch:
+            return 0
+
+        pks, user_pks = zip(*batch)
+
+        self.filter(pk__in=pks).update(activated=True, state=self.model.ACTIVATED)
+        User.objects.filter(pk__in=user_pks).update(is_active=True)
+        RegistrationEvent.objects.record(RegistrationEvent.ACTIVATED, user_pks, backend)
+        RegistrationCounter.objects.incr({'activated': len(pks)})
+
+        # loaded after the update, so receivers see the users as active
+        users = list(User.objects.filter(pk__in=user_pks).order_by('pk'))
+        signals.user_activated.send_many(sender=sender, users=users,
+            request=request, backend=backend)
+
+        return len(users)
+
+    def moderate_profiles(self, profiles, moderator, approve, request=None,
+            backend=None, batch_size=500):
+        """Moderates the profiles of the ``RegistrationProfile`` queryset
+        ``profiles`` which are verified and awaiting moderation, returning a
+        tuple of the primary keys of the profiles moderated and of those
+        activated.
+
+        Each batch of ``batch_size`` profiles is locked, then rejected or
+        approved with one ``UPDATE``. Approved profiles are activated with a
+        second ``UPDATE`` and their users with a third, and
+        ``user_activated`` is sent for them like in ``activate_users``.
+        Profiles whose activation has expired or which were moderated by a
+        concurrent request are skipped.
+        """
+        state = self.model.APPROVED if approve else self.model.REJECTED
+        pending = profiles.filter(not_expired(),
+            state__in=self.model.get_source_states(state)).order_by('pk')
+
+        sender = backend.__class__ if backend else self.model
+        moderated, activated = [], []
+        last_pk = 0
+
+        while True:
+            batch = self._moderate_profiles(pending.filter(pk__gt=last_pk)[:batch_size],
+                moderator, approve, sender, request, backend)
+
+            if not batch:
+                break
+
+            last_pk = batch[0][-1]
+            moderated.extend(batch[0])
+            activated.extend(batch[1])
+
+        return moderated, activated
+
+    @deferred.commit_on_success
+    def _moderate_profiles(self, profiles, moderator, approve, sender, request=None,
+            backend=None):
+        from registration.models import RegistrationEvent, RegistrationCounter
+
+        # rows moderated by a concurrent request are excluded once the lock
+        # is acquired, since their state no longer matches
+        batch = list(profiles.select_for_update().values_list('pk', 'user', 'activation_key'))
+
+        if not batch:
+            return None
+
+        pks, user_pks, activation_keys = zip(*batch)
+
+        self.filter(pk__in=pks).update(moderated=True, moderator=moderator,
+            moderation_time=datetime.now(),
+            state=self.model.APPROVED if approve else self.model.REJECTED)
+        RegistrationEvent.objects.record(RegistrationEvent.MODERATED, user_pks, backend)
+        RegistrationCounter.objects.incr({'moderated': len(pks)})
+
+        if not approve:
+            return list(pks), []
+
+        self.filter(pk__in=pks).update(activated=True, state=self.model.ACTIVATED)
+        User.objects.filter(pk__in=user_pks).update(is_active=True)
+        RegistrationEvent.objects.record(RegistrationEvent.ACTIVATED, user_pks, backend)
+        RegistrationCounter.objects.incr({'activated': len(pks)})
+        keycache.invalidate(activation_keys)
+
+        users = list(User.objects.filter(pk__in=user_pks).order_by('pk'))
+        signals.user_activated.send_many(sender=sender, users=users,
+            request=request, backend=backend)
+
+        return list(pks), list(pks)
+
+    def generate_activation_key(self, user):
+        """Returns a new activation key for ``user``, a SHA1 hash generated
+        from a combination of the ``User``'s username and a random salt.
         """
         salt = hashlib.sha1(str(random.random())).hexdigest()[:5]
         username = user.username
@@ -49,5 +272,303 @@ class RegistrationManager(models.Manager):
         if isinstance(username, unicode):
             username = username.encode('utf-8')
 
-        activation_key = hashlib.sha1(salt+username).hexdigest()
-        return self.create(user=user, activation_key=activation_key)
+        return hashlib.sha1(salt+username).hexdigest()
+
+    def get_expires_at(self, user, activation_days=None):
+        """Returns the time after which ``user`` can no longer activate, i.e.
+        ``activation_days`` (defaulting to ``REGISTRATION_ACTIVATION_DAYS``)
+        after they joined, or ``None`` if activation does not expire.
+        """
+        if activation_days is None:
+            activation_days = getattr(settings, 'REGISTRATION_ACTIVATION_DAYS', 0)
+
+        if activation_days:
+            return (user.date_joined or datetime.now()) + timedelta(days=activation_days)
+
+    def create_profile(self, user, activation_days=None):
+        """Create a ``RegistrationProfile`` for a given ``User``, and return
+        the ``RegistrationProfile``.
+
+        The activation key for the ``RegistrationProfile`` will be a SHA1 hash,
+        generated from a combination of the ``User``'s username and a random
+        salt. The profile expires ``activation_days`` after the user joined.
+        """
+        from registration.models import RegistrationCounter
+
+        activation_key = self.generate_activation_key(user)
+        profile = self.create(user=user, activation_key=activation_key,
+            expires_at=self.get_expires_at(user, activation_days))
+        RegistrationCounter.objects.incr({'registered': 1})
+
+        # the key may have been looked up (and found missing) before
+        keycache.invalidate([activation_key])
+        return profile
+
+    def create_profiles(self, users, activation_days=None):
+        """Create a ``RegistrationProfile`` for each of the saved ``users``
+        with a single ``INSERT``. Profiles are returned with the ``user``
+        set, but without primary keys.
+        """
+        from registration.models import RegistrationCounter
+
+        profiles = [self.model(user=user, activation_key=self.generate_activation_key(user),
+            expires_at=self.get_expires_at(user, activation_days)) for user in users]
+        self.bulk_create(profiles)
+        RegistrationCounter.objects.incr({'registered': len(profiles)})
+
+        keycache.invalidate([profile.activation_key for profile in profiles])
+        return profiles
+
+    def expired(self, now=None):
+        """Returns the profiles which have not been activated and whose
+        activation has expired, as a range scan over ``expires_at``.
+        """
+        return self.filter(activated=False, expires_at__lte=now or datetime.now())
+
+    def pending(self, now=None):
+        "Returns the profiles which have not been activated and have not expired."
+        return self.filter(not_expired(now), activated=False)
+
+    def delete_expired_users(self, activation_days=None, batch_size=1000,
+            dry_run=False, max_runtime=None):
+        """Remove expired instances of ``RegistrationProfile`` and their
+        associated ``User``s.
+
+        Accounts to be deleted are those which have not been activated and
+        whose activation has expired, according to their stored
+        ``expires_at``. If ``activation_days`` is given, accounts whose
+        ``User`` joined more than ``activation_days`` ago are deleted
+        instead. Users which have been set active by other means, e.g. in
+        the admin, are left alone.
+
+        Expired accounts are deleted in batches of ``batch_size``, each in
+        its own transaction, so locks are held briefly and only one batch is
+        in memory at a time. If ``max_runtime`` (in seconds) is given, no new
+        batch is started once it has elapsed.
+
+        Returns the number of accounts deleted or, if ``dry_run`` is true,
+        the number of accounts that would be deleted.
+        """
+        if activation_days is None:
+            profiles = self.expired()
+        elif activation_days:
+            cutoff = datetime.now() - timedelta(days=activation_days)
+            profiles = self.filter(activated=False, user__date_joined__lte=cutoff)
+        else:
+            return 0
+
+        profiles = profiles.filter(user__is_active=False).order_by('pk')
+
+        if dry_run:
+            return profiles.count()
+
+        if max_runtime:
+            deadline = time.time() + max_runtime
+
+        deleted = 0
+        last_pk = 0
+
+        while True:
+            batch = list(profiles.filter(pk__gt=last_pk)
+                .values_list('pk', 'user', 'activation_key', 'verified', 'moderated')[:batch_size])
+
+            if not batch:
+                break
+
+            last_pk = batch[-1][0]
+            pks, user_pks, activation_keys, verified, moderated = zip(*batch)
+
+            # none of the deleted profiles are activated
+            self._delete_users(user_pks, {
+                'registered': -len(batch),
+                'verified': -sum(verified),
+                'moderated': -sum(moderated),
+            })
+            keycache.invalidate(activation_keys)
+            deleted += len(batch)
+
+            if max_runtime and time.time() >= deadline:
+                break
+
+        return deleted
+
+    @transaction.commit_on_success
+    def _delete_users(self, pks, counts):
+        from registration.models import RegistrationCounter
+
+        # profiles are removed by the cascade
+        User.objects.filter(pk__in=pks).delete()
+        RegistrationCounter.objects.incr(counts)
+
+
+class RegistrationEventManager(models.Manager):
+    "Manager for the ``RegistrationEvent`` outbox."
+    def record(self, event, user_pks, backend=None):
+        """Adds an ``event`` for each of the users with ``user_pks`` with a
+        single insert. Call it within the transaction making the change, so
+        the events are committed or rolled back with it.
+        """
+        from registration.backends import get_backend_alias
+
+        alias = get_backend_alias(backend) if backend is not None else None
+
+        self.bulk_create([self.model(event=event, user_pk=pk,
+            backend=alias or '') for pk in user_pks])
+
+    def after(self, position, batch_size=100, settle=None, gaps=()):
+        """Returns up to ``batch_size`` events following the event with the
+        primary key ``position``, in order, preceded by any of the events
+        with the primary keys ``gaps`` which have since been committed.
+
+        Primary keys are assigned when events are inserted, not when they
+        commit, so events younger than ``settle`` seconds are left for the
+        next read in case an older transaction has yet to commit its own.
+        Transactions running longer than that are caught by the consumer's
+        gaps.
+        """
+        if settle is None:
+            settle = getattr(settings, 'REGISTRATION_EVENT_SETTLE', 5)
+
+        following = models.Q(pk__gt=position)
+
+        if settle:
+            following &= models.Q(created__lte=datetime.now() - timedelta(seconds=settle))
+
+        if gaps:
+            following |= models.Q(pk__in=list(gaps))
+
+        return list(self.filter(following).order_by('pk')[:batch_size])
+
+    def delete_consumed(self):
+        """Deletes the events which every consumer has acknowledged,
+        returning the position up to which they were deleted.
+        """
+        from registration.models import RegistrationEventConsumer
+
+        # events which a consumer may still read from its gaps are kept
+        positions = [min([consumer.position] + [pk - 1 for pk in consumer.get_gaps()])
+            for consumer in RegistrationEventConsumer.objects.all()]
+
+        position = min(positions) if positions else None
+
+        if position:
+            self.filter(pk__lte=position).delete()
+
+        return position
+
+
+class RegistrationCounterManager(models.Manager):
+    """Manager for the ``RegistrationCounter`` table, which keeps the number
+    of registration profiles in each stage so they need not be counted.
+
+    Each counter is spread over ``REGISTRATION_COUNTER_SHARDS`` rows and an
+    increment updates a random one, so concurrent registrations rarely wait
+    on each other's row locks.
+    """
+    def incr(self, counts):
+        """Adds the values of the dict ``counts`` to the counters named by its
+        keys. Call it within the transaction making the change.
+        """
+        shards = getattr(settings, 'REGISTRATION_COUNTER_SHARDS', 8)
+        shard = random.randrange(shards)
+
+        for name, count in counts.items():
+            if not count:
+                continue
+
+            if not self.filter(name=name, shard=shard).update(value=models.F('value') + count):
+                self._create(name, shard, count)
+
+    def _create(self, name, shard, count):
+        sid = transaction.savepoint()
+
+        try:
+            self.create(name=name, shard=shard, value=count)
+        except IntegrityError:
+            # another transaction created the row first
+            transaction.savepoint_rollback(sid)
+            self.filter(name=name, shard=shard).update(value=models.F('value') + count)
+        else:
+            transaction.savepoint_commit(sid)
+
+    def _lock(self):
+        """Locks the counters table against writes, including increments
+        creating new shard rows, until the transaction ends.
+        """
+        if connection.vendor == 'postgresql':
+            # conflicts with the locks taken by UPDATE and INSERT, but not
+            # with reads
+            cursor = connection.cursor()
+            cursor.execute('LOCK TABLE {0} IN EXCLUSIVE MODE'.format(
+                connection.ops.quote_name(self.model._meta.db_table)))
+        else:
+            # on MySQL, locking every row also locks the gaps between them
+            # against inserts; SQLite only allows one writer at a time
+            list(self.select_for_update().values_list('pk'))
+
+    def get_counts(self):
+        """Returns a dict of the number of ``registered``, ``verified``,
+        ``moderated``, ``activated`` and ``pending`` (registered but not
+        activated) profiles, with a single query over the counter rows.
+        """
+        counts = dict((name, 0) for name in self.model.NAMES)
+
+        for name, value in self.values_list('name').annotate(value=models.Sum('value')):
+            counts[name] = value
+
+        counts['pending'] = counts['registered'] - counts['activated']
+        return counts
+
+    @transaction.commit_on_success
+    def rebuild(self):
+        """Recounts the profiles in one pass over the profile table, replacing
+        the counters. Returns the new counts.
+
+        The profiles are counted without blocking anything. The counters
+        are read by the same statement, so the changes committed after it
+        are the difference between those values and the current ones. Writes
+        to the counters table are then blocked only while that difference is
+        added and the new counters are swapped in, so changes to profiles
+        made meanwhile are counted once.
+        """
+        from registration.models import RegistrationProfile
+
+        qn = connection.ops.quote_name
+        counts = dict((name, 0) for name in self.model.NAMES)
+        counted = dict((name, 0) for name in self.model.NAMES)
+
+        # at most eight groups of profiles, one per combination of the flags,
+        # followed by the counter totals as they were when the profiles were
+        # read, since a single statement sees a single snapshot
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT NULL, {flags}, COUNT(*) FROM {profiles} GROUP BY {flags}
+            UNION ALL
+            SELECT {name}, NULL, NULL, NULL, SUM({value}) FROM {counters} GROUP BY {name}
+        """.format(profiles=qn(RegistrationProfile._meta.db_table),
+            counters=qn(self.model._meta.db_table), name=qn('name'), value=qn('value'),
+            flags=', '.join(qn(flag) for flag in ('verified', 'moderated', 'activated'))))
+
+        for name, verified, moderated, activated, count in cursor.fetchall():
+            if name is not None:
+                counted[name] = count
+                continue
+
+            counts['registered'] += count
+            if verified:
+                counts['verified'] += count
+            if moderated:
+                counts['moderated'] += count
+            if activated:
+                counts['activated'] += count
+
+        self._lock()
+
+        for name, value in self.values_list('name').annotate(value=models.Sum('value')):
+            counts[name] += value - counted.get(name, 0)
+
+        self.all().delete()
+        self.bulk_create([self.model(name=name, shard=0, value=value)
+            for name, value in counts.items()])
+
+        return self.get_counts()
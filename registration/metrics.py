@@ -0,0 +1,175 @@
+"""Timers and counters for the stages of the registration process.
+
+Backend methods time each stage, e.g. ``register.form_save`` or
+``verify.email``, and count the failures and database queries of each. The
+measurements are emitted to the sink set with ``REGISTRATION_METRICS_SINK``:
+
+* ``registration.metrics.LoggingSink`` (default) logs them at ``DEBUG``
+  level to the ``registration.metrics`` logger.
+* ``registration.metrics.StatsdSink`` sends them over UDP to the StatsD
+  server at ``REGISTRATION_STATSD_HOST`` and ``REGISTRATION_STATSD_PORT``.
+* ``registration.metrics.MemorySink`` keeps them in process memory, e.g.
+  for tests.
+* ``None`` disables metrics.
+
+Queries are only counted when Django records them, i.e. with ``DEBUG`` on or
+the connection's ``use_debug_cursor`` set.
+"""
+import time
+import socket
+import logging
+import threading
+from functools import wraps
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+
+from registration.utils import import_path
+
+logger = logging.getLogger(__name__)
+
+REGISTRATION_METRICS_SINK = getattr(settings, 'REGISTRATION_METRICS_SINK',
+    'registration.metrics.LoggingSink')
+
+REGISTRATION_METRICS_PREFIX = getattr(settings, 'REGISTRATION_METRICS_PREFIX', 'registration')
+
+REGISTRATION_STATSD_HOST = getattr(settings, 'REGISTRATION_STATSD_HOST', 'localhost')
+
+REGISTRATION_STATSD_PORT = getattr(settings, 'REGISTRATION_STATSD_PORT', 8125)
+
+
+class BaseSink(object):
+    "Interface for metric sinks."
+    def timing(self, name, ms):
+        "Records a duration of ``ms`` milliseconds for ``name``."
+        raise NotImplementedError
+
+    def incr(self, name, count=1):
+        "Adds ``count`` to the counter ``name``."
+        raise NotImplementedError
+
+
+class LoggingSink(BaseSink):
+    "Logs metrics at ``DEBUG`` level."
+    def timing(self, name, ms):
+        logger.debug('{0}.{1}: {2:.3f}ms'.format(REGISTRATION_METRICS_PREFIX, name, ms))
+
+    def incr(self, name, count=1):
+        logger.debug('{0}.{1}: +{2}'.format(REGISTRATION_METRICS_PREFIX, name, count))
+
+
+class StatsdSink(BaseSink):
+    """Sends metrics to a StatsD server. Packets which cannot be sent are
+    dropped, so an unavailable server never fails a request.
+    """
+    def __init__(self, host=REGISTRATION_STATSD_HOST, port=REGISTRATION_STATSD_PORT,
+            prefix=REGISTRATION_METRICS_PREFIX):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, data):
+        try:
+            self.socket.sendto(data, self.address)
+        except socket.error:
+            pass
+
+    def timing(self, name, ms):
+        self.send('{0}.{1}:{2:.3f}|ms'.format(self.prefix, name, ms))
+
+    def incr(self, name, count=1):
+        self.send('{0}.{1}:{2}|c'.format(self.prefix, name, count))
+
+
+class MemorySink(BaseSink):
+    "Keeps metrics in process memory."
+    def __init__(self):
+        self.timings = defaultdict(list)
+        self.counters = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def timing(self, name, ms):
+        with self.lock:
+            self.timings[name].append(ms)
+
+    def incr(self, name, count=1):
+        with self.lock:
+            self.counters[name] += count
+
+    def clear(self):
+        with self.lock:
+            self.timings.clear()
+            self.counters.clear()
+
+
+_sink = None
+
+def get_sink():
+    """Returns the sink set by ``REGISTRATION_METRICS_SINK``, or ``None`` if
+    metrics are disabled.
+    """
+    global _sink
+
+    if _sink is None and REGISTRATION_METRICS_SINK:
+        try:
+            sink_class = import_path(REGISTRATION_METRICS_SINK)
+        except (ImportError, AttributeError), e:
+            raise ImproperlyConfigured('Error loading metrics sink {0}: "{1}"'.format(REGISTRATION_METRICS_SINK, e))
+
+        _sink = sink_class()
+
+    return _sink
+
+
+def incr(name, count=1):
+    "Adds ``count`` to the counter ``name``."
+    sink = get_sink()
+    if sink is not None:
+        sink.incr(name, count)
+
+
+def queries_logged():
+    "Indicate whether the default connection records its queries."
+    return connection.use_debug_cursor or \
+        (connection.use_debug_cursor is None and settings.DEBUG)
+
+
+@contextmanager
+def timer(name):
+    """Times the block as ``name``. The number of queries it executes is
+    added to ``<name>.queries`` and exceptions are counted in
+    ``<name>.failures``.
+    """
+    sink = get_sink()
+
+    if sink is None:
+        yield
+        return
+
+    queries = len(connection.queries) if queries_logged() else None
+    start = time.time()
+
+    try:
+        yield
+    except:
+        sink.incr(name + '.failures')
+        raise
+    finally:
+        sink.timing(name, (time.time() - start) * 1000)
+
+        if queries is not None:
+            sink.incr(name + '.queries', len(connection.queries) - queries)
+
+
+def timed(name):
+    "Decorator which times each call of the function with ``timer``."
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
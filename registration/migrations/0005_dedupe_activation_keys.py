@@ -0,0 +1,101 @@
+# encoding: utf-8
+import random
+import hashlib
+from south.db import db
+from south.v2 import DataMigration
+from django.db import models
+
+# placeholder key older versions stored for every activated profile
+ALREADY_ACTIVATED = 'ALREADY_ACTIVATED'
+
+class Migration(DataMigration):
+
+    def forwards(self, orm):
+        """Ensures no two profiles share an activation key so a unique index
+        can be built on the column.
+        """
+        # the placeholder is rewritten in a single statement by suffixing the
+        # primary key, which keeps it unique and still not a valid SHA1 hash
+        if db.backend_name == 'mysql':
+            key = "CONCAT(activation_key, '_', id)"
+        else:
+            key = "activation_key || '_' || id"
+
+        db.execute('UPDATE registration_registrationprofile SET activation_key = {0} '
+            'WHERE activation_key = %s'.format(key), [ALREADY_ACTIVATED])
+
+        # any other collision is a genuine (and extremely unlikely) clash of
+        # two generated keys. all but the first profile get a new key.
+        profiles = orm.RegistrationProfile.objects
+        duplicates = profiles.values('activation_key')\
+            .annotate(count=models.Count('id')).filter(count__gt=1)
+
+        for row in list(duplicates):
+            pks = profiles.filter(activation_key=row['activation_key'])\
+                .order_by('pk').values_list('pk', flat=True)
+
+            for pk in list(pks)[1:]:
+                salt = hashlib.sha1(str(random.random())).hexdigest()[:5]
+                activation_key = hashlib.sha1(salt + str(pk)).hexdigest()
+                profiles.filter(pk=pk).update(activation_key=activation_key)
+
+
+    def backwards(self, orm):
+        "Restores the placeholder key for activated profiles."
+        profiles = orm.RegistrationProfile.objects.filter(
+            activation_key__startswith=ALREADY_ACTIVATED + '_')
+        profiles.update(activation_key=ALREADY_ACTIVATED)
+
+
+    models = {
+        'auth.group': {
+            'Meta': {'object_name': 'Group'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'})
+        },
+        'auth.permission': {
+            'Meta': {'ordering': "('content_type__app_label', 'content_type__model', 'codename')", 'unique_together': "(('content_type', 'codename'),)", 'object_name': 'Permission'},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        'auth.user': {
+            'Meta': {'object_name': 'User'},
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Group']", 'symmetrical': 'False', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        },
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'registration.registrationprofile': {
+            'Meta': {'object_name': 'RegistrationProfile'},
+            'activated': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'activation_key': ('django.db.models.fields.CharField', [], {'max_length': '40'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'moderated': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'moderation_time': ('django.db.models.fields.DateTimeField', [], {'null': 'True'}),
+            'moderator': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'moderated_profiles'", 'null': 'True', 'to': "orm['auth.User']"}),
+            'user': ('django.db.models.fields.related.OneToOneField', [], {'related_name': "'registration'", 'unique': 'True', 'to': "orm['auth.User']"}),
+            'verified': ('django.db.models.fields.BooleanField', [], {'default': 'False'})
+        }
+    }
+
+    complete_apps = ['registration']
+
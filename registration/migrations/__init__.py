@@ -0,0 +1,16 @@
+from south.db import db
+
+
+def create_index_concurrently(table, name, definition, unique=False):
+    """Builds the index ``name`` on ``table`` over ``definition``, e.g.
+    ``'(state, id)'``, on PostgreSQL.
+
+    PostgreSQL can build an index without locking out writes to the table,
+    but only outside of a transaction block, so the migration's transaction
+    is committed first and a new one started afterwards. The index is named
+    explicitly so that it can be dropped by name.
+    """
+    db.commit_transaction()
+    db.execute('CREATE {0}INDEX CONCURRENTLY {1} ON {2} {3}'.format(
+        'UNIQUE ' if unique else '', name, table, definition))
+    db.start_transaction()
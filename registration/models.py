@@ -1,9 +1,15 @@
+import json
+import time
 from datetime import datetime, timedelta
 
+from django.conf import settings
 from django.db import models, transaction
+from django.core.mail import EmailMessage
 from django.utils.translation import ugettext_lazy as _
 
-from registration.managers import RegistrationManager
+from registration import keycache
+from registration.managers import RegistrationManager, RegistrationEventManager, \
+    RegistrationCounterManager
 from registration.user import User
 
 
@@ -21,11 +27,36 @@ class RegistrationProfile(models.Model):
     model's sole purpose is to store data temporarily during account
     registration and activation.
     """
+    PENDING = 0
+    VERIFIED = 1
+    REJECTED = 2
+    ACTIVATED = 3
+    APPROVED = 4
+
+    STATE_CHOICES = (
+        (PENDING, _('pending')),
+        (VERIFIED, _('verified')),
+        (REJECTED, _('rejected')),
+        (APPROVED, _('approved')),
+        (ACTIVATED, _('activated')),
+    )
+
+    # the states a profile in each state can move to. only verified profiles
+    # are moderated. approved profiles stay approved if their activation has
+    # expired, and rejected ones can still be activated, e.g. from the admin
+    TRANSITIONS = {
+        PENDING: (VERIFIED, ACTIVATED),
+        VERIFIED: (REJECTED, APPROVED, ACTIVATED),
+        REJECTED: (ACTIVATED,),
+        APPROVED: (ACTIVATED,),
+        ACTIVATED: (),
+    }
 
     user = models.OneToOneField(User, related_name='registration_profile',
         verbose_name=_('user'))
 
-    activation_key = models.CharField(_('activation key'), max_length=40)
+    activation_key = models.CharField(_('activation key'), max_length=40,
+        unique=True)
 
     # for moderated account registration, this denotes the user has verified
     # they account e.g. clicked on a link sent to their email address
@@ -45,6 +76,18 @@ class RegistrationProfile(models.Model):
     # the time the user was moderated
     moderation_time = models.DateTimeField(_('moderation_time'), null=True)
 
+    # the stage of the registration as a single column, moved together with
+    # the flags above by ``RegistrationProfile.objects.transition``. it is
+    # indexed together with the primary key so the backend's queues are range
+    # scans with ``REGISTRATION_PROFILE_STATE`` on
+    state = models.PositiveSmallIntegerField(_('state'), choices=STATE_CHOICES,
+        default=PENDING)
+
+    # the time after which the profile can no longer be activated, or null
+    # if activation does not expire
+    expires_at = models.DateTimeField(_('expires at'), null=True, blank=True,
+        db_index=True)
+
     objects = RegistrationManager()
 
     class Meta(object):
@@ -57,15 +100,48 @@ class RegistrationProfile(models.Model):
     def save(self, *args, **kwargs):
         if not self.moderation_time and self.moderated:
             self.moderation_time = datetime.now()
+        # keep the state in step with flags set directly, e.g. in the admin
+        self.state = self.get_state()
         super(RegistrationProfile, self).save(*args, **kwargs)
 
+    def get_state(self):
+        """Returns the state corresponding to the profile's flags. The flags
+        do not record whether a moderator approved a profile whose activation
+        then expired, so a moderated profile is reported as rejected unless
+        its state is approved already.
+        """
+        if self.activated:
+            return self.ACTIVATED
+        if not self.verified:
+            return self.PENDING
+        if self.moderated:
+            return self.APPROVED if self.state == self.APPROVED else self.REJECTED
+        return self.VERIFIED
+
+    def can_transition(self, state):
+        "Indicate whether the profile may move from its state to ``state``."
+        return state in self.TRANSITIONS[self.state]
+
+    @classmethod
+    def get_source_states(cls, state):
+        "Returns the states from which a profile may move to ``state``."
+        return [source for source, targets in cls.TRANSITIONS.items() if state in targets]
+
     @transaction.commit_on_success
-    def activate(self):
+    def activate(self, backend=None):
+        """Activates the profile and its user, unless another request has
+        done so already. Returns the user, or ``False`` if the profile was
+        already activated.
+        """
+        if not RegistrationProfile.objects.transition(self, self.ACTIVATED, activated=True):
+            return False
+
         user = self.user
         user.is_active = True
         user.save()
-        self.activated = True
-        self.save()
+        RegistrationEvent.objects.record(RegistrationEvent.ACTIVATED, [user.pk], backend)
+        RegistrationCounter.objects.incr({'activated': 1})
+        keycache.invalidate([self.activation_key])
         return user
 
     def activation_expired(self, activation_days=None):
@@ -83,7 +159,13 @@ class RegistrationProfile(models.Model):
         allowed to activate their account); if the result is less than or equal
         to the current date, the key has expired and this method returns
         ``True``.
+
+        Unless ``activation_days`` is given, the stored ``expires_at`` is used,
+        which is set to the same date when the profile is created.
         """
+        if activation_days is None:
+            return self.expires_at is not None and self.expires_at <= datetime.now()
+
         # if this is not set or is 0, always return False (no expiration)
         if not activation_days:
             return False
@@ -94,3 +176,226 @@ class RegistrationProfile(models.Model):
 
     # for the admin..
     activation_expired.boolean = True
+
+
+class QueuedEmail(models.Model):
+    """An email waiting to be delivered by ``registration.mail.DatabaseQueue``.
+    Rows are deleted once the email has been sent.
+    """
+    subject = models.TextField(_('subject'))
+    body = models.TextField(_('body'))
+    from_email = models.CharField(_('from email'), max_length=255)
+
+    # newline-separated, since addresses may contain commas
+    recipients = models.TextField(_('recipients'))
+
+    created = models.DateTimeField(_('created'), default=datetime.now)
+
+    # number of failed delivery attempts
+    attempts = models.PositiveIntegerField(_('attempts'), default=0)
+
+    # the email is not picked up by a worker before this time
+    next_attempt = models.DateTimeField(_('next attempt'), default=datetime.now,
+        db_index=True)
+
+    last_error = models.TextField(_('last error'), blank=True)
+
+    class Meta(object):
+        verbose_name = _('queued email')
+        verbose_name_plural = _('queued emails')
+
+    def __unicode__(self):
+        return self.subject
+
+    def message(self):
+        "Returns an ``EmailMessage`` for this email."
+        return EmailMessage(self.subject, self.body, self.from_email,
+            self.recipients.splitlines())
+
+
+class PendingSignal(models.Model):
+    """A registration signal waiting to be delivered to a receiver connected
+    with the ``outbox`` mode. Rows are written in the transaction sending the
+    signal and deleted once the receiver has returned.
+    """
+    # name of the signal in ``registration.signals``
+    signal = models.CharField(_('signal'), max_length=50)
+
+    # dotted path of the receiver function
+    receiver = models.CharField(_('receiver'), max_length=255)
+
+    user = models.ForeignKey(User, related_name='pending_registration_signals',
+        verbose_name=_('user'))
+
+    # alias of the sending backend, blank if it is not registered
+    backend = models.CharField(_('backend'), max_length=50, blank=True)
+
+    # dotted path of the sender class, blank if the signal had no sender
+    sender = models.CharField(_('sender'), max_length=255, blank=True)
+
+    created = models.DateTimeField(_('created'), default=datetime.now)
+
+    # number of failed delivery attempts
+    attempts = models.PositiveIntegerField(_('attempts'), default=0)
+
+    # the signal is not picked up by a worker before this time
+    next_attempt = models.DateTimeField(_('next attempt'), default=datetime.now,
+        db_index=True)
+
+    last_error = models.TextField(_('last error'), blank=True)
+
+    class Meta(object):
+        verbose_name = _('pending signal')
+        verbose_name_plural = _('pending signals')
+
+    def __unicode__(self):
+        return u'{0} for {1}'.format(self.signal, self.receiver)
+
+
+class RegistrationEvent(models.Model):
+    """A change in the registration of a user, written in the same
+    transaction as the change. Events are read in order of their primary key,
+    which consumers use as their position in the stream.
+    """
+    REGISTERED = 'registered'
+    VERIFIED = 'verified'
+    MODERATED = 'moderated'
+    ACTIVATED = 'activated'
+
+    EVENT_CHOICES = (
+        (REGISTERED, _('registered')),
+        (VERIFIED, _('verified')),
+        (MODERATED, _('moderated')),
+        (ACTIVATED, _('activated')),
+    )
+
+    event = models.CharField(_('event'), max_length=20, choices=EVENT_CHOICES)
+
+    # not a foreign key, so events outlive users removed by the cleanup
+    user_pk = models.IntegerField(_('user id'))
+
+    # alias of the backend which made the change, blank if unknown
+    backend = models.CharField(_('backend'), max_length=50, blank=True)
+
+    created = models.DateTimeField(_('created'), default=datetime.now)
+
+    objects = RegistrationEventManager()
+
+    class Meta(object):
+        verbose_name = _('registration event')
+        verbose_name_plural = _('registration events')
+
+    def __unicode__(self):
+        return u'{0} {1}'.format(self.user_pk, self.event)
+
+    def as_dict(self):
+        "Returns the event as a JSON serializable dict."
+        return {
+            'id': self.pk,
+            'event': self.event,
+            'user': self.user_pk,
+            'backend': self.backend,
+            'created': self.created.isoformat(),
+        }
+
+
+class RegistrationEventConsumer(models.Model):
+    """The position of a named consumer in the ``RegistrationEvent`` stream,
+    i.e. the primary key of the last event it acknowledged.
+
+    Events can commit out of primary key order, so primary keys skipped
+    between the events of a read are kept as the consumer's gaps. They are
+    read again until they show up or ``REGISTRATION_EVENT_GAP_TIMEOUT``
+    seconds have passed, after which their transaction is assumed to have
+    rolled back. At most ``REGISTRATION_EVENT_MAX_GAPS`` are kept, dropping
+    the oldest first.
+    """
+    name = models.CharField(_('name'), max_length=100, unique=True)
+
+    position = models.IntegerField(_('position'), default=0)
+
+    # JSON object mapping unread primary keys below the position to the
+    # time they were first missed
+    gaps = models.TextField(_('gaps'), blank=True)
+
+    updated = models.DateTimeField(_('updated'), default=datetime.now)
+
+    class Meta(object):
+        verbose_name = _('registration event consumer')
+        verbose_name_plural = _('registration event consumers')
+
+    def __unicode__(self):
+        return self.name
+
+    def get_gaps(self):
+        "Returns a dict of the unread primary keys below the position."
+        return dict((int(pk), missed) for pk, missed in json.loads(self.gaps or '{}').items())
+
+    def read(self, batch_size=100, settle=None):
+        "Returns the next ``batch_size`` events, without acknowledging them."
+        events = RegistrationEvent.objects.after(self.position, batch_size,
+            settle, self.get_gaps().keys())
+        self._read = set(event.pk for event in events)
+        return events
+
+    def ack(self, event):
+        """Acknowledges ``event`` and every event before it, so they are not
+        read again. The position never moves backwards.
+
+        Primary keys missing between the position and the events of the last
+        ``read``, up to ``event``, are added to the gaps. A new consumer
+        starts at the first event it reads.
+        """
+        position = event.pk if isinstance(event, RegistrationEvent) else event
+        read = getattr(self, '_read', set())
+
+        max_gaps = getattr(settings, 'REGISTRATION_EVENT_MAX_GAPS', 1000)
+        timeout = getattr(settings, 'REGISTRATION_EVENT_GAP_TIMEOUT', 600)
+
+        gaps = self.get_gaps()
+        now = time.time()
+
+        following = sorted(pk for pk in read if self.position < pk <= position)
+
+        if following:
+            previous = self.position or following[0]
+
+            for pk in following:
+                # only the last max_gaps keys of a long run would be kept
+                for missing in xrange(max(previous + 1, pk - max_gaps), pk):
+                    gaps.setdefault(missing, now)
+                previous = pk
+
+        gaps = sorted((pk, missed) for pk, missed in gaps.items()
+            if pk not in read and now - missed < timeout)
+
+        self.gaps = json.dumps(dict(gaps[-max_gaps:])) if gaps and max_gaps else ''
+        self.position = max(self.position, position)
+        self._read = set()
+
+        RegistrationEventConsumer.objects.filter(pk=self.pk, position__lte=self.position)\
+            .update(position=self.position, gaps=self.gaps, updated=datetime.now())
+
+
+class RegistrationCounter(models.Model):
+    """One shard of a count of registration profiles, maintained as profiles
+    are created, verified, moderated, activated and deleted by the cleanup.
+    Use ``RegistrationCounter.objects.get_counts()`` to read the totals.
+    """
+    NAMES = ('registered', 'verified', 'moderated', 'activated')
+
+    name = models.CharField(_('name'), max_length=20)
+
+    shard = models.PositiveSmallIntegerField(_('shard'), default=0)
+
+    value = models.IntegerField(_('value'), default=0)
+
+    objects = RegistrationCounterManager()
+
+    class Meta(object):
+        unique_together = ('name', 'shard')
+        verbose_name = _('registration counter')
+        verbose_name_plural = _('registration counters')
+
+    def __unicode__(self):
+        return u'{0} ({1})'.format(self.name, self.shard)
@@ -0,0 +1,138 @@
+"""Token bucket rate limiting for the registration views.
+
+Limits are configured per scope with ``REGISTRATION_RATE_LIMITS``, mapping
+the scope to a tuple of the bucket size and the number of seconds it takes
+to refill completely::
+
+    REGISTRATION_RATE_LIMITS = {
+        # registration attempts per IP address
+        'register': (10, 3600),
+        # registration attempts per email address
+        'register_email': (3, 3600),
+        # verification link lookups per IP address
+        'verify': (30, 600),
+    }
+
+Scopes without a limit are not limited. Buckets are stored by the backend
+set with ``REGISTRATION_RATE_LIMIT_BACKEND``, by default ``CacheBackend``
+which uses the cache named by ``REGISTRATION_RATE_LIMIT_CACHE``.
+``LocalBackend`` keeps buckets in process memory, e.g. for tests.
+"""
+import time
+import hashlib
+import threading
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.core.exceptions import ImproperlyConfigured
+
+from registration.utils import import_path
+
+REGISTRATION_RATE_LIMITS = getattr(settings, 'REGISTRATION_RATE_LIMITS', {})
+
+REGISTRATION_RATE_LIMIT_BACKEND = getattr(settings, 'REGISTRATION_RATE_LIMIT_BACKEND',
+    'registration.ratelimit.CacheBackend')
+
+REGISTRATION_RATE_LIMIT_CACHE = getattr(settings, 'REGISTRATION_RATE_LIMIT_CACHE', 'default')
+
+
+def refill(bucket, capacity, period, now):
+    "Returns the number of tokens in ``bucket`` at ``now``."
+    if bucket is None:
+        return capacity
+    tokens, timestamp = bucket
+    return min(capacity, tokens + (now - timestamp) * capacity / float(period))
+
+
+class BaseBackend(object):
+    "Interface for bucket storage."
+    def consume(self, key, capacity, period):
+        """Takes a token from the bucket ``key``, returning whether one was
+        available.
+        """
+        raise NotImplementedError
+
+
+class LocalBackend(BaseBackend):
+    "Keeps buckets in process memory."
+    def __init__(self):
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def consume(self, key, capacity, period):
+        now = time.time()
+
+        with self.lock:
+            tokens = refill(self.buckets.get(key), capacity, period, now)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.buckets[key] = (tokens, now)
+
+        return allowed
+
+    def clear(self):
+        with self.lock:
+            self.buckets.clear()
+
+
+class CacheBackend(BaseBackend):
+    """Keeps buckets in a Django cache, so limits are shared between
+    processes. Concurrent requests for the same key may occasionally both be
+    allowed since the cache is read and written without a lock.
+    """
+    def __init__(self, alias=REGISTRATION_RATE_LIMIT_CACHE):
+        self.cache = get_cache(alias)
+
+    def consume(self, key, capacity, period):
+        now = time.time()
+
+        tokens = refill(self.cache.get(key), capacity, period, now)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+
+        # a bucket untouched for a full period is full again, so it can expire
+        self.cache.set(key, (tokens, now), period)
+
+        return allowed
+
+
+_backend = None
+
+def get_backend():
+    "Returns the bucket storage set by ``REGISTRATION_RATE_LIMIT_BACKEND``."
+    global _backend
+
+    if _backend is None:
+        try:
+            backend_class = import_path(REGISTRATION_RATE_LIMIT_BACKEND)
+        except (ImportError, AttributeError), e:
+            raise ImproperlyConfigured('Error loading rate limit backend {0}: "{1}"'.format(REGISTRATION_RATE_LIMIT_BACKEND, e))
+
+        _backend = backend_class()
+
+    return _backend
+
+
+def allow(scope, identifier):
+    """Returns whether a request in ``scope`` by ``identifier``, e.g. an IP
+    address, is within the limit. Each allowed request takes a token.
+    """
+    if scope not in REGISTRATION_RATE_LIMITS:
+        return True
+
+    capacity, period = REGISTRATION_RATE_LIMITS[scope]
+
+    if isinstance(identifier, unicode):
+        identifier = identifier.encode('utf-8')
+
+    key = 'registration.ratelimit.{0}.{1}'.format(scope, hashlib.sha1(identifier).hexdigest())
+    return get_backend().consume(key, capacity, period)
+
+
+def get_client_ip(request):
+    """Returns the client's IP address. Behind a proxy, ``REMOTE_ADDR``
+    must be set from the forwarded address, e.g. by a middleware.
+    """
+    return request.META.get('REMOTE_ADDR', '')
@@ -1,13 +1,207 @@
+"""Signals sent during the registration process.
+
+By default receivers are called while the registration step sending the
+signal runs, i.e. inside its transaction. With ``REGISTRATION_SIGNAL_DISPATCH``
+set to ``'on_commit'``, they are called once the step has committed and not
+at all if it is rolled back.
+
+Receivers doing slow work, e.g. calling external services, can be connected
+with a ``mode`` so the request does not wait on them::
+
+    user_registered.connect(sync_crm, mode='thread')
+
+* ``'thread'`` receivers are called on a pool of
+  ``REGISTRATION_SIGNAL_WORKERS`` background threads once the step has
+  committed, with ``request=None`` since the response may already have been
+  returned. Calls which have not run are lost if the process exits.
+* ``'outbox'`` receivers are recorded in the ``PendingSignal`` table within
+  the step's transaction, and called by the ``sendregistrationsignals``
+  command. Each is called at least once, with the original sender and
+  ``request=None``, and retried
+  up to ``REGISTRATION_SIGNAL_MAX_ATTEMPTS`` times if it raises an exception.
+  Receivers must be module-level functions, since they are imported by
+  their dotted path.
+"""
+import logging
+
+from django.conf import settings
+from django.db import connection
 from django.dispatch import Signal
+from django.dispatch.dispatcher import _make_id
+
+from registration import deferred
+from registration.utils import import_path
+from registration.workers import ThreadPool, claim, retry
+
+logger = logging.getLogger(__name__)
+
+REGISTRATION_SIGNAL_DISPATCH = getattr(settings, 'REGISTRATION_SIGNAL_DISPATCH', 'immediate')
+
+REGISTRATION_SIGNAL_WORKERS = getattr(settings, 'REGISTRATION_SIGNAL_WORKERS', 2)
+
+REGISTRATION_SIGNAL_MAX_ATTEMPTS = getattr(settings, 'REGISTRATION_SIGNAL_MAX_ATTEMPTS', 5)
+
+REGISTRATION_SIGNAL_RETRY_DELAY = getattr(settings, 'REGISTRATION_SIGNAL_RETRY_DELAY', 60)
+
+SYNC = 'sync'
+THREAD = 'thread'
+OUTBOX = 'outbox'
+
+# registration signals by name, for delivering pending signals
+_signals = {}
+
+_pool = ThreadPool(REGISTRATION_SIGNAL_WORKERS)
+
+
+def get_receiver_path(receiver):
+    return '{0}.{1}'.format(receiver.__module__, receiver.__name__)
+
+
+def call_in_thread(receiver, signal, sender, **named):
+    "Calls ``receiver`` and closes the thread's database connection."
+    try:
+        receiver(signal=signal, sender=sender, **named)
+    except Exception:
+        logger.exception('Error calling receiver {0!r} of {1}'.format(receiver, signal.name))
+    finally:
+        connection.close()
+
+
+class RegistrationSignal(Signal):
+    """A signal whose receivers can be deferred until the sending transaction
+    commits, called on background threads or recorded in an outbox.
+    """
+    def __init__(self, name, providing_args=None):
+        super(RegistrationSignal, self).__init__(providing_args)
+        self.name = name
+        self.threaded = Signal(providing_args)
+        self.outbox = []
+        _signals[name] = self
+
+    def connect(self, receiver, sender=None, weak=True, dispatch_uid=None, mode=SYNC):
+        if mode == THREAD:
+            self.threaded.connect(receiver, sender, weak, dispatch_uid)
+        elif mode == OUTBOX:
+            if sender is not None:
+                raise ValueError('Outbox receivers cannot be connected to a sender')
+            path = get_receiver_path(receiver)
+            if path not in self.outbox:
+                self.outbox.append(path)
+        elif mode == SYNC:
+            super(RegistrationSignal, self).connect(receiver, sender, weak, dispatch_uid)
+        else:
+            raise ValueError('Unknown signal dispatch mode "{0}"'.format(mode))
+
+    def disconnect(self, receiver=None, sender=None, weak=True, dispatch_uid=None):
+        super(RegistrationSignal, self).disconnect(receiver, sender, weak, dispatch_uid)
+        self.threaded.disconnect(receiver, sender, weak, dispatch_uid)
+
+        if receiver is not None and get_receiver_path(receiver) in self.outbox:
+            self.outbox.remove(get_receiver_path(receiver))
+
+    def send(self, sender, **named):
+        """Records the signal for outbox receivers, then calls the other
+        receivers immediately or after commit, depending on
+        ``REGISTRATION_SIGNAL_DISPATCH`` and their mode. Returns the
+        responses of receivers called immediately.
+        """
+        if self.outbox:
+            self.record(sender, [named.get('user')], named.get('backend'))
+
+        if self.threaded.receivers:
+            deferred.on_commit(self.submit, sender, **named)
+
+        if REGISTRATION_SIGNAL_DISPATCH == 'on_commit':
+            deferred.on_commit(super(RegistrationSignal, self).send, sender, **named)
+            return []
+
+        return super(RegistrationSignal, self).send(sender, **named)
+
+    def send_many(self, sender, users, **named):
+        """Sends the signal for each of ``users``, from a step changing them
+        all in one transaction. Rows for the outbox receivers are added with
+        a single insert in that transaction, while the other receivers are
+        called for each user once it has committed.
+        """
+        if self.outbox:
+            self.record(sender, users, named.get('backend'))
+
+        deferred.on_commit(self._send_many, sender, users, **named)
+
+    def _send_many(self, sender, users, **named):
+        for user in users:
+            if self.threaded.receivers:
+                self.submit(sender, user=user, **named)
+            super(RegistrationSignal, self).send(sender, user=user, **named)
+
+    def submit(self, sender, **named):
+        "Calls the threaded receivers on the thread pool."
+        # the request has been responded to by the time receivers run
+        named['request'] = None
+
+        for receiver in self.threaded._live_receivers(_make_id(sender)):
+            _pool.submit(call_in_thread, receiver, self, sender, **named)
+
+    def record(self, sender, users, backend):
+        """Adds rows for the outbox receivers to the ``PendingSignal`` table,
+        for each of ``users``.
+        """
+        from registration.backends import get_backend_alias
+        from registration.models import PendingSignal
+
+        alias = get_backend_alias(backend) if backend is not None else None
+        sender_path = get_receiver_path(sender) if sender is not None else ''
+
+        PendingSignal.objects.bulk_create([PendingSignal(signal=self.name,
+            receiver=receiver, user=user, backend=alias or '', sender=sender_path)
+            for user in users for receiver in self.outbox])
+
+
+def deliver_pending(batch_size=100):
+    """Calls the receivers of up to ``batch_size`` due pending signals.
+    Returns a tuple of the number of signals delivered and failed.
+    """
+    from registration.backends import get_backend
+    from registration.models import PendingSignal
+
+    pks = claim(PendingSignal.objects.all(), batch_size, REGISTRATION_SIGNAL_MAX_ATTEMPTS)
+    pending = PendingSignal.objects.select_related('user')\
+        .filter(pk__in=pks).order_by('pk')
+
+    delivered = []
+    failed = 0
+
+    for item in pending:
+        try:
+            signal = _signals[item.signal]
+            receiver = import_path(item.receiver)
+
+            backend = get_backend(item.backend) if item.backend else None
+            sender = import_path(item.sender) if item.sender else None
+
+            receiver(signal=signal, sender=sender, user=item.user,
+                request=None, backend=backend)
+
+            delivered.append(item.pk)
+        except Exception, e:
+            failed += 1
+            logger.warning('Error delivering {0} to {1}: {2}'.format(item.signal,
+                item.receiver, e))
+            retry(item, e, REGISTRATION_SIGNAL_RETRY_DELAY)
+
+    PendingSignal.objects.filter(pk__in=delivered).delete()
+
+    return len(delivered), failed
+
 
 # A new user has registered.
-user_registered = Signal(providing_args=['user', 'request', 'backend'])
+user_registered = RegistrationSignal('user_registered', providing_args=['user', 'request', 'backend'])
 
 # A new user has verified their registration.
-user_verified = Signal(providing_args=['user', 'request', 'backend'])
+user_verified = RegistrationSignal('user_verified', providing_args=['user', 'request', 'backend'])
 
 # A user has activated his or her account.
-user_activated = Signal(providing_args=['user', 'request', 'backend'])
+user_activated = RegistrationSignal('user_activated', providing_args=['user', 'request', 'backend'])
 
 # A user has been moderated.
-user_moderated = Signal(providing_args=['user', 'request', 'backend'])
+user_moderated = RegistrationSignal('user_moderated', providing_args=['user', 'request', 'backend'])
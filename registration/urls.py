@@ -9,18 +9,21 @@ urlpatterns = patterns('',
         template_name='registration/registration_complete.html'
     ), name='registration-complete'),
 
-    # Activation keys get matched by \w+ instead of the more specific
+    # Activation keys get matched by [\w:-]+ instead of the more specific
     # [a-fA-F0-9]{40} because a bad activation key should still get to the view;
     # that way it can return a sensible "invalid key" message instead of a
-    # confusing 404.
-    url(r'^verify/(?P<activation_key>\w+)/$', verify,
+    # confusing 404. Signed activation tokens contain colons and dashes.
+    url(r'^verify/(?P<activation_key>[\w:-]+)/$', verify,
         name='verify-registration'),
 
     url(r'^register/closed/$', TemplateView.as_view(
         template_name='registration/registration_closed.html'
     ), name='registration-disabled'),
 
-    url(r'^moderate/(?P<activation_key>\w+)/$', 'registration.views.moderate',
+    url(r'^moderate/many/$', 'registration.views.moderate_many',
+        name='moderate-registration-many'),
+
+    url(r'^moderate/(?P<activation_key>[\w:-]+)/$', 'registration.views.moderate',
         name='moderate-registration'),
 
     url(r'^moderate/$', 'registration.views.moderate_list',
@@ -1,27 +1,67 @@
 import re
+import time
 import random
 
 from django import forms
+from django.db import transaction, IntegrityError
 from django.utils.translation import ugettext_lazy as _
 from django.conf.urls import patterns, url
 
-from registration.user import User
+# Python 2.7 has an importlib with import_module; for older Pythons,
+# Django's bundled copy provides it.
+try:
+    from importlib import import_module
+except ImportError:
+    from django.utils.importlib import import_module
 
-USERNAME_LEN_MIN = 10 ** 10
-USERNAME_LEN_MAX = 30 ** 10
+# base32 alphabet in ascending ASCII order, so usernames sort by creation time
+USERNAME_ALPHABET = '0123456789abcdefghijklmnopqrstuv'
+USERNAME_RANDOM_BITS = 72
+USERNAME_LENGTH = 24
 
-def generate_random_username(attempts=10):
-    qs = User.objects.all()
-    r = random.SystemRandom()
+_random = random.SystemRandom()
 
-    for i in xrange(attempts):
-        username = str(r.randint(USERNAME_LEN_MIN, USERNAME_LEN_MAX))
+def import_path(path):
+    """Returns the module attribute named by the dotted ``path``, e.g. a class
+    set in a setting. Raises ``ImportError`` or ``AttributeError`` if it
+    does not exist.
+    """
+    i = path.rfind('.')
+    return getattr(import_module(path[:i]), path[i+1:])
+
+def generate_random_username():
+    """Returns a random username which is unique without having to check the
+    database. It encodes a millisecond timestamp followed by 72 random bits,
+    so a collision requires two usernames generated in the same millisecond
+    to draw the same random bits.
+    """
+    value = int(time.time() * 1000) << USERNAME_RANDOM_BITS \
+        | _random.getrandbits(USERNAME_RANDOM_BITS)
+
+    chars = []
+    for i in xrange(USERNAME_LENGTH):
+        value, index = divmod(value, len(USERNAME_ALPHABET))
+        chars.append(USERNAME_ALPHABET[index])
 
-        # ensure this alias is not already taken
-        if not qs.filter(username=username).exists():
-            return username
+    return ''.join(reversed(chars))
+
+def save_with_random_username(user, attempts=3):
+    """Saves a new ``user`` with a random username. Should the username be
+    taken regardless, the insert fails and is retried with a new one.
+    """
+    for i in xrange(attempts):
+        user.username = generate_random_username()
+        sid = transaction.savepoint()
 
-    raise StandardError('max attempts have been reached (n={0})'.format(attempts))
+        try:
+            user.save()
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+            if i == attempts - 1:
+                raise
+        else:
+            transaction.savepoint_commit(sid)
+            return user
 
 def validate_password(password, length):
     "Validates the given password."
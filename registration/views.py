@@ -1,10 +1,14 @@
 from django.shortcuts import redirect
 from django.shortcuts import render
 from django.views.decorators.cache import never_cache
+from django.views.decorators.http import require_POST
 from django.contrib.auth.decorators import permission_required
 
 from registration.backends import get_backend
 
+MODERATION_LIST_FIELDS = ('activation_key', 'verified', 'user__first_name',
+    'user__last_name', 'user__email')
+
 def register(request, backend='default', template_name='registration/registration_form.html'):
     backend = get_backend(backend)
 
@@ -16,6 +20,13 @@ def register(request, backend='default', template_name='registration/registratio
 
     form_class = backend.get_registration_form_class(request)
 
+    # turn away clients over the rate limit before validating anything
+    if not backend.registration_attempt_allowed(request):
+        return render(request, template_name, {
+            'form': form_class(),
+            'rate_limited': True,
+        }, status=429)
+
     if request.method == 'POST':
         form = form_class(request.POST, request.FILES)
 
@@ -30,6 +41,14 @@ def register(request, backend='default', template_name='registration/registratio
 @never_cache
 def verify(request, backend='default', template_name='registration/registration_verify.html', **kwargs):
     backend = get_backend(backend)
+
+    # turn away clients probing for keys before looking anything up
+    if not backend.verification_allowed(request):
+        return render(request, template_name, {
+            'profile': None,
+            'moderation_required': None,
+        }, status=429)
+
     profile = backend.get_profile(request, **kwargs)
 
     if profile:
@@ -70,11 +89,51 @@ def moderate(request, backend='default', template_name='registration/registratio
         'profile': profile,
     })
 
+@require_POST
+@permission_required('registration.change_registrationprofile')
+def moderate_many(request, backend='default', template_name='registration/registration_moderate_list.html'):
+    """Approves or rejects the profiles selected in the moderation queue. If
+    the selection is invalid, the queue is shown again with the errors.
+    """
+    backend = get_backend(backend)
+    form = backend.get_bulk_moderation_form_class(request)(request.POST)
+
+    if form.is_valid():
+        backend.moderate_many(request, form, form.cleaned_data['profiles'])
+        return redirect(backend.post_moderation_redirect(request, None))
+
+    return render_moderation_list(request, backend, template_name, form)
+
 @permission_required('registration.change_registrationprofile')
 def moderate_list(request, backend='default', template_name='registration/registration_moderate_list.html'):
     backend = get_backend(backend)
-    profiles = backend.get_unmoderated_profiles(request)
+    form = backend.get_bulk_moderation_form_class(request)()
+    return render_moderation_list(request, backend, template_name, form)
+
+def render_moderation_list(request, backend, template_name, form):
+    page_size = backend.get_moderation_page_size(request)
+
+    # only the columns displayed in the list are loaded
+    profiles = backend.get_unmoderated_profiles(request).order_by('pk')\
+        .only(*MODERATION_LIST_FIELDS)
+
+    # pages are addressed by the last primary key of the previous page, so
+    # every page is a range scan no matter how deep into the queue it is
+    after = request.GET.get('after', '')
+    if after.isdigit():
+        profiles = profiles.filter(pk__gt=after)
+
+    # fetch one extra row to determine if there is a next page
+    profiles = list(profiles[:page_size + 1])
+
+    if len(profiles) > page_size:
+        profiles = profiles[:page_size]
+        next_cursor = profiles[-1].pk
+    else:
+        next_cursor = None
 
     return render(request, template_name, {
+        'form': form,
         'profiles': profiles,
+        'next_cursor': next_cursor,
     })
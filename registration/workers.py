@@ -0,0 +1,90 @@
+import Queue
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from django.db import transaction
+from django.db.models import F
+
+logger = logging.getLogger(__name__)
+
+
+class ThreadPool(object):
+    """A fixed number of daemon threads which call submitted functions in the
+    background. Threads are started on the first submission so the pool can
+    be created at import time, e.g. before a server forks its workers.
+    """
+    def __init__(self, size=2):
+        self.size = size
+        self.tasks = Queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def submit(self, func, *args, **kwargs):
+        "Queues ``func`` to be called with the given arguments."
+        self._start()
+        self.tasks.put((func, args, kwargs))
+
+    def join(self):
+        "Blocks until all submitted functions have been called."
+        self.tasks.join()
+
+    def _start(self):
+        if len(self.threads) >= self.size:
+            return
+
+        with self.lock:
+            while len(self.threads) < self.size:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def _work(self):
+        while True:
+            func, args, kwargs = self.tasks.get()
+
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                logger.exception('Error calling {0!r} in worker thread'.format(func))
+            finally:
+                self.tasks.task_done()
+
+
+def retry_delay(delay, attempts):
+    """Returns the number of seconds to wait after ``attempts`` failed
+    attempts, starting at ``delay`` and doubling after each one.
+    """
+    return delay * 2 ** (attempts - 1)
+
+
+@transaction.commit_on_success
+def claim(queryset, batch_size, max_attempts, lease=300):
+    """Claims up to ``batch_size`` due rows of ``queryset``, a table of work
+    with ``attempts`` and ``next_attempt`` columns, returning their primary
+    keys. Their next attempt is moved ``lease`` seconds ahead, so several
+    workers can process the table at the same time.
+    """
+    now = datetime.now()
+
+    due = queryset.select_for_update()\
+        .filter(attempts__lt=max_attempts, next_attempt__lte=now)\
+        .order_by('next_attempt')
+
+    pks = list(due.values_list('pk', flat=True)[:batch_size])
+
+    queryset.filter(pk__in=pks).update(next_attempt=now + timedelta(seconds=lease))
+
+    return pks
+
+
+def retry(item, error, delay):
+    """Records a failed attempt at ``item``, a row claimed with ``claim``,
+    and schedules the next one after ``retry_delay``.
+    """
+    attempts = item.attempts + 1
+    next_attempt = datetime.now() + timedelta(seconds=retry_delay(delay, attempts))
+
+    type(item)._default_manager.filter(pk=item.pk).update(attempts=F('attempts') + 1,
+        next_attempt=next_attempt, last_error=unicode(error))